@@ -31,6 +31,9 @@ cp labs.run.yaml services/portal/usr/local/etc/labs.yaml
 # Copy notifications config values
 cat labs.run.yaml | j2 --format=yaml services/useretc/app/notifications/ical.yaml.j2 > services/useretc/app/notifications/ical.yaml
 
+# Copy useretc database config values
+cat labs.run.yaml | j2 --format=yaml services/useretc/app/database/config.yaml.j2 > services/useretc/app/database/config.yaml
+
 # Copy configs 
 # Do something here
 
@@ -0,0 +1,76 @@
+"""
+Benchmark portallib.access_rules against the frozen pandas pipeline it replaced.
+
+Times the non-HTTP part of PortalUser.get_user_data_from_access_api for a typical login:
+a handful of labs and access rows for username, !username, *, !* and !!.
+
+Needs pandas < 3 (the portal image runs python3.10):
+
+    python bench_access_rules.py [--iterations 200]
+"""
+
+import argparse
+import time
+
+from check_access_rules import (
+    USERNAME,
+    access_row,
+    resolve_with_engine,
+    resolve_with_pandas,
+)
+
+LAB_CONFIG = {
+    "ip_country_status": {"limited": ["CN"], "prohibited": ["IR", "KP"]},
+    "labs": [
+        {"short_name": "smce-prod-opensarlab", "accessibility": "protected"},
+        {"short_name": "smce-test-opensarlab", "accessibility": "private"},
+        {"short_name": "avo-prod", "accessibility": "public"},
+        {"short_name": "workshop", "accessibility": "private", "enabled": False},
+        {
+            "short_name": "edu",
+            "accessibility": "protected",
+            "ip_country_status": {"limited": ["US"]},
+        },
+    ],
+}
+
+ACCESS_DATA = [
+    access_row("smce-prod-opensarlab", USERNAME, "m6a.large,m6a.xlarge"),
+    access_row("smce-test-opensarlab", USERNAME, "gpu,!m6a.xlarge", "=> 2099-01-01"),
+    access_row("edu", USERNAME, "small", "2000-01-01 => 2001-01-01"),
+    access_row("smce-prod-opensarlab", "*", "m6a.large"),
+    access_row("smce-test-opensarlab", "*", "m6a.large,m6a.xlarge"),
+    access_row("avo-prod", "*", "default"),
+    access_row("edu", "*", "small,medium"),
+    access_row("workshop", "!*", ""),
+    access_row("workshop", "*", "small"),
+]
+
+
+def time_per_call(resolve, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        resolve(ACCESS_DATA, LAB_CONFIG, "US")
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    assert resolve_with_pandas(ACCESS_DATA, LAB_CONFIG, "US") == resolve_with_engine(
+        ACCESS_DATA, LAB_CONFIG, "US"
+    )
+
+    pandas_seconds = time_per_call(resolve_with_pandas, args.iterations)
+    # The engine is fast enough to need more iterations for a stable number
+    engine_seconds = time_per_call(resolve_with_engine, args.iterations * 100)
+
+    print(f"pandas: {pandas_seconds * 1000:.3f} ms per resolution")
+    print(f"engine: {engine_seconds * 1000:.3f} ms per resolution")
+    print(f"speedup: {pandas_seconds / engine_seconds:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Differential check of portallib.access_rules against the frozen pandas pipeline it replaced.
+
+Runs hand-written edge cases plus seeded random access rows and labs configs through both and
+fails on the first difference, including lab order, profile order and raised exceptions.
+
+Needs pandas < 3 (the portal image runs python3.10):
+
+    python check_access_rules.py [--cases 2000] [--seed 0]
+"""
+
+import argparse
+import logging
+import pathlib
+import random
+import sys
+import warnings
+
+HERE = pathlib.Path(__file__).parent.resolve()
+sys.path.insert(0, str(HERE.parent / "usr/local/lib/python3.10/dist-packages"))
+sys.path.insert(0, str(HERE))
+
+from portallib import access_rules
+from portallib.config import LabsConfig
+from reference_pandas_access import PandasAccessResolver
+
+USERNAME = "jdoe"
+
+LAB_SHORT_NAMES = ["lab-a", "lab-b", "lab-c", "lab-d"]
+PROFILES = ["p1", "p2", "p3", " p1 ", "!p1", "!p2", "!!p3", "!", "", "None"]
+COUNTRY_CODES = ["US", "CA", "IR", "KP", None]
+ACTIVE_TILL_DATES = [
+    None,
+    "",
+    "None",
+    "2099-01-01",
+    "2000-01-01",
+    "=> 2099-01-01",
+    "2000-01-01 => 2099-01-01",
+    "'2000-01-01' => '2001-01-01'",
+    '"2098-01-01" =>',
+    "2099-01-01 => 2000-01-01",
+    "2000-01-01T00:00:00+00:00 => 2099-01-01T00:00:00-08:00",
+    "not-a-date",
+    "=> not-a-date",
+    "2000-01-01 => 2050-01-01 => 2099-01-01",
+]
+
+
+def resolve_with_engine(
+    access_data: list, lab_config: dict, country_code: str
+) -> dict:
+    """
+    Same steps as PortalUser.get_user_data_from_access_api, minus the HTTP fetch.
+    """
+    labs_config = LabsConfig(lab_config)
+    rules = access_rules.compile_access_rules(access_data)
+    if not rules:
+        return {}
+    lab_country_statuses = access_rules.get_effective_lab_country_statuses(
+        labs_config, country_code
+    )
+    return access_rules.resolve_lab_access(rules, labs_config, lab_country_statuses)
+
+
+def resolve_with_pandas(
+    access_data: list, lab_config: dict, country_code: str
+) -> dict:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return PandasAccessResolver(lab_config).get_user_data_from_access_api(
+            country_code, access_data
+        )
+
+
+def access_row(
+    lab_short_name: str,
+    username: str,
+    lab_profiles: str,
+    active_till_dates: str = None,
+    row_id: int = 1,
+) -> dict:
+    return {
+        "lab_short_name": lab_short_name,
+        "username": username,
+        "row_id": row_id,
+        "lab_profiles": lab_profiles,
+        "active_till_dates": active_till_dates,
+        "time_quota": None,
+        "comments": None,
+    }
+
+
+def random_lab_config(rnd: random.Random) -> dict:
+    def ip_country_status():
+        return {
+            "limited": rnd.sample(COUNTRY_CODES[:4], rnd.randint(0, 2)),
+            "prohibited": rnd.sample(COUNTRY_CODES[:4], rnd.randint(0, 1)),
+        }
+
+    labs = []
+    for lab_short_name in LAB_SHORT_NAMES[: rnd.randint(1, len(LAB_SHORT_NAMES))]:
+        lab = {"short_name": lab_short_name}
+        if rnd.random() < 0.8:
+            lab["accessibility"] = rnd.choice(["public", "protected", "private"])
+        if rnd.random() < 0.3:
+            lab["enabled"] = rnd.choice([True, False])
+        if rnd.random() < 0.5:
+            lab["ip_country_status"] = ip_country_status()
+        labs.append(lab)
+
+    lab_config = {"labs": labs}
+    if rnd.random() < 0.5:
+        lab_config["ip_country_status"] = ip_country_status()
+    return lab_config
+
+
+def random_access_data(rnd: random.Random) -> list:
+    usernames = [USERNAME, f"!{USERNAME}", "*", "!*", "!!", f" {USERNAME} "]
+    weights = [8, 1, 8, 1, 1, 1]
+
+    rows = []
+    for row_id in range(rnd.randint(0, 12)):
+        lab_profiles = ",".join(rnd.sample(PROFILES, rnd.randint(1, 4)))
+        rows.append(
+            access_row(
+                rnd.choice(LAB_SHORT_NAMES + ["lab-not-in-config"]),
+                rnd.choices(usernames, weights)[0],
+                rnd.choice([lab_profiles, lab_profiles, None]),
+                rnd.choice(ACTIVE_TILL_DATES),
+                row_id,
+            )
+        )
+
+    # Same ordering as the access API: grouped by username
+    order = {username.strip(): i for i, username in enumerate(usernames)}
+    rows.sort(key=lambda row: order[row["username"].strip()])
+    return rows
+
+
+EDGE_CASES = [
+    [],
+    [access_row("lab-a", USERNAME, "p1,p2"), access_row("lab-a", "*", "p3")],
+    [access_row("lab-a", USERNAME, "p1", "=> 2000-01-01"), access_row("lab-a", "*", "p3")],
+    [access_row("lab-a", USERNAME, "p1", "=> 2000-01-01")],
+    [access_row("lab-a", f"!{USERNAME}", ""), access_row("lab-a", "*", "p")],
+    [access_row("lab-a", "!*", ""), access_row("lab-a", "*", "p"), access_row("lab-a", USERNAME, "z")],
+    [access_row("lab-a", "!!", ""), access_row("lab-a", USERNAME, "p")],
+    [access_row("lab-a", USERNAME, "p1,!p2"), access_row("lab-a", "*", "p2,p3")],
+    [access_row("lab-a", USERNAME, "")],
+    [access_row("lab-a", USERNAME, None), access_row("lab-a", "*", "k")],
+    [access_row("lab-a", USERNAME, "p1,p1 , p2"), access_row("lab-a", "*", "p1")],
+    [access_row("lab-c", "*", "k"), access_row("lab-b", "*", "k"), access_row("lab-a", "*", "k")],
+]
+
+EDGE_LAB_CONFIG = {
+    "labs": [
+        {"short_name": "lab-a", "accessibility": "public"},
+        {"short_name": "lab-b", "accessibility": "protected"},
+        {"short_name": "lab-c", "accessibility": "private"},
+    ]
+}
+
+
+def compare(access_data: list, lab_config: dict, country_code: str) -> None:
+    def run(resolve):
+        try:
+            return resolve(access_data, lab_config, country_code), None
+        except Exception as e:
+            return None, type(e)
+
+    expected, expected_error = run(resolve_with_pandas)
+    actual, actual_error = run(resolve_with_engine)
+
+    # Compare as item lists so lab order matters too
+    same = expected_error == actual_error and (
+        expected_error or list(expected.items()) == list(actual.items())
+    )
+    if not same:
+        raise AssertionError(
+            f"Mismatch\n{country_code=}\n{lab_config=}\n{access_data=}\n"
+            f"pandas: {expected or expected_error}\nengine: {actual or actual_error}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Both sides log every unparsable active_till_dates value
+    logging.disable(logging.ERROR)
+
+    for access_data in EDGE_CASES:
+        for country_code in COUNTRY_CODES:
+            compare(access_data, EDGE_LAB_CONFIG, country_code)
+    # An unknown accessibility fails the same way on both sides
+    compare(
+        [access_row("lab-a", USERNAME, "p1")],
+        {"labs": [{"short_name": "lab-a", "accessibility": "secret"}]},
+        "US",
+    )
+    print(f"{len(EDGE_CASES)} edge cases match")
+
+    rnd = random.Random(args.seed)
+    non_empty = 0
+    for _ in range(args.cases):
+        access_data = random_access_data(rnd)
+        lab_config = random_lab_config(rnd)
+        country_code = rnd.choice(COUNTRY_CODES)
+        compare(access_data, lab_config, country_code)
+        non_empty += bool(resolve_with_engine(access_data, lab_config, country_code))
+    print(f"{args.cases} random cases match ({non_empty} with lab access)")
+
+
+if __name__ == "__main__":
+    main()
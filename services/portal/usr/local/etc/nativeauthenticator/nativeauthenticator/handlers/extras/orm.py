@@ -12,6 +12,8 @@ from sqlalchemy import LargeBinary
 from sqlalchemy import String
 from sqlalchemy.orm import validates
 
+from portallib.auth_cache import auth_cache
+
 
 class UserInfo(Base):
     """
@@ -85,6 +87,7 @@ class UserInfo(Base):
         user = db.query(cls).filter(cls.username == username).first()
         user.is_authorized = not user.is_authorized
         db.commit()
+        auth_cache.invalidate([username])
         return user
 
     @classmethod
@@ -101,6 +104,7 @@ class UserInfo(Base):
         if user.is_authorized:
             user.is_authorized = False
             db.commit()
+            auth_cache.invalidate([username])
 
         return user
 
@@ -114,6 +118,7 @@ class UserInfo(Base):
         user = db.query(cls).filter(cls.username == username).first()
         user.has_2fa = False
         db.commit()
+        auth_cache.invalidate([username])
         return user
 
     def is_valid_password(self, password):
@@ -4,6 +4,7 @@ import pyotp
 
 from .extras.base import LocalBase
 from .mfa import generate_mfa_qrcode
+from portallib.auth_cache import auth_cache
 
 
 class Setup2FAHandler(LocalBase):
@@ -50,6 +51,7 @@ class Setup2FAHandler(LocalBase):
             authed_user.has_2fa = True
             authed_user.otp_secret = new_secret
             self.authenticator.db.commit()
+            auth_cache.invalidate([user.name])
         else:
             self.set_status(400)  # Bad Request
 
@@ -1,16 +1,23 @@
+import asyncio
 import json
+import time
 import traceback
 from ipaddress import ip_address as ipa
 
 from tornado import web
+from jupyterhub.scopes import needs_scope
 from tornado.escape import json_decode
 from .base import BaseHandler
 
 from portallib.user import PortalUser
+from portallib.auth_cache import auth_cache
 from opensarlab.auth import encryptedjwt
 
 import logging
 
+# Max seconds any single upstream call within _get_data may take before its default is used instead
+DATA_FETCH_TIMEOUT_SECONDS = 10
+
 
 class AuthHandler(BaseHandler):
     def __init__(self, *args, **kwargs):
@@ -50,8 +57,27 @@ class AuthHandler(BaseHandler):
 
         """
         portal_user = PortalUser(username)
-
-        if update_ip_location:
+        timings = {}
+        # Stages whose data couldn't be fetched. Such results are not cached.
+        incomplete = []
+
+        async def _timed(stage: str, coro, default):
+            start = time.perf_counter()
+            try:
+                return await asyncio.wait_for(coro, timeout=DATA_FETCH_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                self.log.error(
+                    f"Auth: {stage} for {username=} timed out after {DATA_FETCH_TIMEOUT_SECONDS} seconds"
+                )
+                incomplete.append(stage)
+                return default
+            finally:
+                timings[stage] = time.perf_counter() - start
+
+        async def _update_geolocation() -> str:
+            """
+            Returns the country code written, or None if the geolocation was not updated.
+            """
             ## If X-localhost is 'set', always update the geolocation.
             ## Otherwise, if ip_add is within any private network, don't update
             ## This meant to be used from a browser request. Otherwise, non-person IPs will be picked up.
@@ -71,27 +97,86 @@ class AuthHandler(BaseHandler):
                 self.log.warning(
                     f"Update entry to geolocation DB table: {username=}, {portal_ip_country_status=}, {country_code=}, {ip_add=}, {is_localdev=}"
                 )
-                await portal_user.update_user_geolocation_with_geolocation_api(
-                    portal_ip_country_status, country_code, ip_add
+                await _timed(
+                    "geolocation_update",
+                    portal_user.update_user_geolocation_with_geolocation_api(
+                        portal_ip_country_status, country_code, ip_add
+                    ),
+                    None,
                 )
+                return country_code
 
-        hub_data: dict = await portal_user.get_user_data_from_hub_api()
+            return None
 
-        user_profile: dict = await portal_user.get_user_profile_data_from_profile_api()
+        async def _get_bundle_and_access() -> tuple:
+            # The only real dependency chain: the latest geolocation must be read after it is updated,
+            # and lab access depends on the resulting country code.
+            if update_ip_location and not geolocation_updated:
+                await _update_geolocation()
 
-        hub_data["force_user_profile_update"] = user_profile.get("force_update", True)
+            # Profile, latest ip info and access rows for username in one request
+            bundle: dict = await _timed(
+                "bundle", portal_user.get_user_bundle_from_bundle_api(), {}
+            )
+            if not bundle:
+                incomplete.append("bundle")
+            user_profile: dict = bundle.get("profile", {})
+            country_code: str = bundle.get("geolocation", {}).get("country_code", None)
+
+            lab_access: dict = await _timed(
+                "access",
+                portal_user.get_user_data_from_access_api(
+                    country_code, access_data=bundle.get("access", [])
+                ),
+                {},
+            )
+
+            return user_profile, country_code, lab_access
+
+        geolocation_updated = False
+        hub_data = auth_cache.get(username)
+        if hub_data is not None:
+            if not update_ip_location:
+                return hub_data
 
-        # Always grab latest ip info for username
-        geolocation_data: dict = (
-            await portal_user.get_latest_user_geolocation_from_geolocation_api()
+            # Always record the browser's location. If the country changed, the cached data is stale.
+            geolocation_updated = True
+            country_code = await _update_geolocation()
+            if country_code is None or country_code == hub_data.get("country_code"):
+                return hub_data
+
+            auth_cache.invalidate([username])
+
+        cache_version = auth_cache.version()
+        start = time.perf_counter()
+
+        hub_data, has_2fa, (user_profile, country_code, lab_access) = (
+            await asyncio.gather(
+                _timed("hub_user", portal_user.get_user_data_from_hub_api(), {}),
+                _timed("mfa", portal_user.get_user_mfa_status(), None),
+                _get_bundle_and_access(),
+            )
         )
-        country_code: str = geolocation_data.get("country_code", None)
-        hub_data["country_code"] = country_code
 
-        hub_data["lab_access"] = await portal_user.get_user_data_from_access_api(
-            country_code
+        timings["total"] = time.perf_counter() - start
+        self.log.info(
+            f"Auth: user data for {username=} gathered in "
+            + ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in timings.items())
         )
 
+        # The hub API failed or the user doesn't exist. Don't build user data around an empty hub user.
+        if not hub_data.get("name"):
+            raise Exception(f"No hub user data for {username=}")
+
+        # The MFA status couldn't be read, so the lab access withheld below must not be cached
+        if has_2fa is None and "mfa" not in incomplete:
+            incomplete.append("mfa")
+
+        hub_data["has_2fa"] = has_2fa
+        hub_data["force_user_profile_update"] = user_profile.get("force_update", True)
+        hub_data["country_code"] = country_code
+        hub_data["lab_access"] = lab_access
+
         if not hub_data["has_2fa"]:
             hub_data["lab_access"] = {}
 
@@ -105,6 +190,9 @@ class AuthHandler(BaseHandler):
 
         logging.warn(f"************************------------- {hub_data}")
 
+        if not incomplete:
+            auth_cache.set(username, hub_data, cache_version)
+
         return hub_data
 
     async def post(self):
@@ -217,4 +305,29 @@ class AuthHandler(BaseHandler):
         self.redirect(next_url)
 
 
-default_handlers = [(r"/auth", AuthHandler)]
+class AuthCacheHandler(BaseHandler):
+    @needs_scope("admin:users")
+    async def get(self):
+        """
+        Hit, miss and invalidation counters of the auth data cache.
+        """
+        self.write(json.dumps(auth_cache.stats()))
+
+    async def post(self):
+        """
+        *For internal services*
+
+        Invalidate cached auth data. The body is encrypted {"usernames": list[str] | None}. None invalidates everyone.
+        """
+        try:
+            data = encryptedjwt.decrypt(self.request.body)
+            usernames = data.get("usernames", None)
+        except Exception as e:
+            self.log.error(f"Auth cache: bad invalidation request: {e}")
+            raise web.HTTPError(400, "Bad invalidation request")
+
+        auth_cache.invalidate(usernames)
+        self.write(json.dumps({"message": "OK"}))
+
+
+default_handlers = [(r"/auth", AuthHandler), (r"/auth/cache", AuthCacheHandler)]
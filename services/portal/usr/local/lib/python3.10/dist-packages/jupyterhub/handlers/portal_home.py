@@ -2,7 +2,6 @@ import os
 import json
 from ipaddress import ip_address as ipa
 
-import yaml
 from tornado import web
 from tornado.httpclient import AsyncHTTPClient
 
@@ -10,6 +9,7 @@ from .base import BaseHandler
 
 from portallib.user import PortalUser
 from portallib.misc import is_deployment_healthy
+from portallib import config
 from opensarlab.auth import encryptedjwt
 
 
@@ -32,9 +32,8 @@ class PortalHomeHandler(BaseHandler):
             raise My401Exception("No portal domain")
 
         # Get config lab info for page
-        with open("/usr/local/etc/labs.yaml", "r") as f:
-            lab_config = yaml.load(f, Loader=yaml.FullLoader)
-        self.all_labs_in_config = lab_config["labs"]
+        self.labs_config = config.get_labs_config()
+        self.all_labs_in_config = self.labs_config.labs
 
     @web.authenticated
     async def get(self):
@@ -110,7 +109,7 @@ class PortalHomeHandler(BaseHandler):
         mylabs = []
 
         user_data_access: dict = user_data.get("lab_access", {})
-        config_labs = {lab["short_name"]: lab for lab in self.all_labs_in_config}
+        config_labs = self.labs_config.labs_by_short_name
 
         is_global_lab_country_status_limited = False
         all_lab_card_seen = []
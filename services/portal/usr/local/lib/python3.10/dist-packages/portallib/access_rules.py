@@ -0,0 +1,371 @@
+"""
+Resolve a user's lab access from their access rows.
+
+The access rows for a user (username, !username, *, !* and !!) are compiled into compact rule records
+and then resolved per lab against the portal config.
+"""
+
+import datetime
+import functools
+import logging
+from typing import TYPE_CHECKING, List, NamedTuple, Optional, Tuple
+
+if TYPE_CHECKING:
+    from portallib.config import LabsConfig
+
+# Effective country status of a lab. Portal status takes precendent.
+#
+#                 | Portal
+# Lab             | Unrestricted  | Limited       | Prohibited    |
+# ----------------|------------------------------------------------
+# Unrestricted    | Unrestricted  | Limited       | Prohibited    |
+# Limited         | Limited       | Limited       | Prohibited    |
+# Prohibited      | Prohibited    | Prohibited    | Prohibited    |
+#
+# COUNTRY_STATUS_MATRIX[lab_status][portal_status]
+COUNTRY_STATUS_MATRIX = {
+    "unrestricted": {
+        "unrestricted": "unrestricted",
+        "limited": "limited",
+        "prohibited": "prohibited",
+    },
+    "limited": {
+        "unrestricted": "limited",
+        "limited": "limited",
+        "prohibited": "prohibited",
+    },
+    "prohibited": {
+        "unrestricted": "prohibited",
+        "limited": "prohibited",
+        "prohibited": "prohibited",
+    },
+}
+
+# User access status by lab country status and lab accessibility. Prohibited labs never get this far.
+#
+#                 | Lab country status
+# Accessibility   | Unrestricted  | Limited       |
+# ----------------|--------------------------------
+# Public          | Automatic     | Requested     |
+# Protected       | Requested     | Requested     |
+# Private         | Special       | Special       |
+#
+# USER_ACCESS_STATUS_MATRIX[lab_country_status][lab_accessibility]
+USER_ACCESS_STATUS_MATRIX = {
+    "unrestricted": {
+        "public": "automatic",
+        "protected": "requested",
+        "private": "special",
+    },
+    "limited": {
+        "public": "requested",
+        "protected": "requested",
+        "private": "special",
+    },
+}
+
+
+def _consolidate_country_status(ip_country_status: dict, country_code: str) -> str:
+    effective_country_status = "unrestricted"
+    if country_code in (ip_country_status.get("limited") or []):
+        effective_country_status = "limited"
+    if country_code in (ip_country_status.get("prohibited") or []):
+        effective_country_status = "prohibited"
+
+    return effective_country_status
+
+
+def compile_country_status_table(
+    portal_ip_country_status: dict, lab_ip_country_status: dict
+) -> Tuple[dict, dict]:
+    """
+    Effective country status by lab short name for every country code named anywhere in the config.
+
+    return: (table keyed by country code, statuses for any country code not in the table)
+    """
+
+    def effective_lab_statuses_for(country_code) -> dict:
+        portal_effective_country_status = _consolidate_country_status(
+            portal_ip_country_status, country_code
+        )
+
+        effective_lab_statuses = {}
+        for lab_short_name, ip_country_status in lab_ip_country_status.items():
+            lab_effective_country_status = _consolidate_country_status(
+                ip_country_status, country_code
+            )
+            effective_lab_statuses[lab_short_name] = COUNTRY_STATUS_MATRIX[
+                lab_effective_country_status
+            ][portal_effective_country_status]
+
+        return effective_lab_statuses
+
+    country_codes = set()
+    for ip_country_status in [portal_ip_country_status, *lab_ip_country_status.values()]:
+        for status in ("limited", "prohibited"):
+            country_codes.update(ip_country_status.get(status) or [])
+
+    table = {
+        country_code: effective_lab_statuses_for(country_code)
+        for country_code in country_codes
+    }
+    # A country code that isn't named anywhere is unrestricted everywhere
+    default = {
+        lab_short_name: COUNTRY_STATUS_MATRIX["unrestricted"]["unrestricted"]
+        for lab_short_name in lab_ip_country_status
+    }
+
+    return table, default
+
+
+def get_effective_lab_country_statuses(
+    labs_config: "LabsConfig", country_code: str
+) -> dict:
+    """
+    The user's effective country status by lab short name for the given country code.
+
+    The returned dict is shared with the config and must not be modified.
+    """
+    return labs_config.country_status_table.get(
+        country_code, labs_config.default_lab_country_statuses
+    )
+
+
+class AccessRule(NamedTuple):
+    lab_short_name: str
+    username: str
+    lab_profiles: Tuple[str, ...]
+    # (start, end) the rule is active within. None if the rule is always active.
+    active_window: Optional[Tuple[datetime.datetime, datetime.datetime]]
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_active_till_dates(active_till_dates: str) -> Optional[tuple]:
+    """
+    Parse "date1 => date2", "=> date2" or "date2" into an aware (start, end) window.
+
+    Values that can't be parsed are logged and ignored, i.e. the rule is always active.
+    """
+    if not active_till_dates or active_till_dates == "None":
+        return None
+
+    dates = active_till_dates.split("=>")
+    if len(dates) == 1:
+        date1 = "1900-01-01"
+        date2 = dates[0].replace('"', "").replace("'", "").strip()
+    elif len(dates) == 2:
+        date1 = dates[0].replace('"', "").replace("'", "").strip()
+        date2 = dates[1].replace('"', "").replace("'", "").strip()
+    else:
+        logging.error("More than one ' => ' found in Active Till Dates. Ignoring....")
+        return None
+
+    try:
+        if not date1:
+            date1 = "1900-01-01"
+        date1 = datetime.datetime.fromisoformat(date1)
+    except Exception as e:
+        logging.error(
+            f"Something went wrong with parsing Active Till Dates (date1): {e}. Ignoring..."
+        )
+        return None
+
+    try:
+        if not date2:
+            date2 = "2626-01-01"
+        date2 = datetime.datetime.fromisoformat(date2)
+    except Exception as e:
+        logging.error(
+            f"Something went wrong with parsing Active Till Dates (date2): {e}. Ignoring..."
+        )
+        return None
+
+    if not date2.tzinfo:
+        date2 = date2.astimezone(datetime.timezone.utc)
+
+    if not date1.tzinfo:
+        date1 = date1.astimezone(datetime.timezone.utc)
+
+    if date1 > date2:
+        logging.error(
+            f"Date 1 ({date1}) is greater than Date 2 ({date2}). This is not possible. Ignoring..."
+        )
+        return None
+
+    return date1, date2
+
+
+def compile_access_rules(access_data: List[dict]) -> List[AccessRule]:
+    """
+    Turn access rows (as served by the access API) into rule records.
+
+    All values are stripped strings, so a missing value becomes "None".
+    Comma separated profiles are split up and stripped.
+    """
+    rules = []
+    for row in access_data:
+        lab_profiles = str(row.get("lab_profiles")).strip().split(",")
+        rules.append(
+            AccessRule(
+                lab_short_name=str(row.get("lab_short_name")).strip(),
+                username=str(row.get("username")).strip(),
+                lab_profiles=tuple(profile.strip() for profile in lab_profiles),
+                active_window=_parse_active_till_dates(
+                    str(row.get("active_till_dates")).strip()
+                ),
+            )
+        )
+    return rules
+
+
+def _resolve_lab(rules: List[AccessRule], user_access_status: str) -> Optional[dict]:
+    #####
+    # Remove negated usernames
+    #####
+    # Special use case: '!!' will negate all profiles in the lab and effectively deny access to everyone
+    if any(rule.username == "!!" for rule in rules):
+        return None
+
+    # If '!*', then negate just any '*'
+    # This would be useful if only access to defaults needs to be denied for everyone
+    if any(rule.username == "!*" for rule in rules):
+        rules = [rule for rule in rules if rule.username not in ("!*", "*")]
+
+    # Any remaining !username will deny access for that user
+    if any(rule.username.startswith("!") for rule in rules):
+        return None
+
+    #####
+    # Remove negated profiles
+    #####
+    exclaim_profiles = set(
+        profile
+        for rule in rules
+        for profile in rule.lab_profiles
+        if profile.startswith("!")
+    )
+    unexclaim_profiles = set(p.lstrip("!") for p in exclaim_profiles)
+    delete_profiles = exclaim_profiles | unexclaim_profiles
+
+    entries = [
+        (rule.username, profile)
+        for rule in rules
+        for profile in rule.lab_profiles
+        if profile not in delete_profiles
+    ]
+
+    #####
+    # Find final access status
+    #####
+    is_lab_access_automatic = user_access_status == "automatic"
+    is_lab_access_requested = user_access_status == "requested"
+    is_lab_access_special = user_access_status == "special"
+
+    # If every username is a wildcard, then none are explicit usernames
+    has_explicit_username = any(username != "*" for username, _ in entries)
+
+    can_user_access_lab = (
+        is_lab_access_automatic
+        or (is_lab_access_requested and has_explicit_username)
+        or (is_lab_access_special and has_explicit_username)
+    )
+    can_user_see_lab_card = (
+        is_lab_access_automatic
+        or is_lab_access_requested
+        or (is_lab_access_special and has_explicit_username)
+    )
+
+    #####
+    # Remove empty and duplicate profiles
+    # We are doing this here at the end after the usernames have been handled. If an explicit username has been given without any profiles, it is still valid.
+    #####
+    lab_profiles = list(
+        dict.fromkeys(
+            profile for _, profile in entries if profile not in ("", "None")
+        )
+    )
+
+    if not lab_profiles:
+        return None
+
+    return {
+        "lab_profiles": lab_profiles,
+        "can_user_access_lab": can_user_access_lab,
+        "can_user_see_lab_card": can_user_see_lab_card,
+    }
+
+
+def resolve_lab_access(
+    rules: List[AccessRule],
+    labs_config: "LabsConfig",
+    lab_country_statuses: dict,
+    now: datetime.datetime = None,
+) -> dict:
+    """
+    Resolve compiled access rules into the user's access by lab.
+
+    params: lab_country_statuses. The user's effective country status by lab short name.
+
+    return: A dict containing user access info by lab, sorted by lab short name.
+
+        {
+            '{lab_short_name}': {
+                'lab_profiles': list[str],
+                'lab_country_status': 'unrestricted' || 'limited',
+                'can_user_access_lab': bool,
+                'can_user_see_lab_card': bool,
+                'time_quota': None,
+            },
+        }
+
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    rules_by_lab = {}
+    user_access_status_by_lab = {}
+
+    for rule in rules:
+        lab_short_name = rule.lab_short_name
+
+        # Lab must be in the portal config and enabled there
+        if not labs_config.lab_enabled.get(lab_short_name, False):
+            continue
+
+        lab_country_status = lab_country_statuses.get(lab_short_name, "unknown")
+        if lab_country_status in ("prohibited", "unknown"):
+            continue
+
+        if lab_short_name not in user_access_status_by_lab:
+            lab_accessibility = labs_config.lab_accessibility.get(
+                lab_short_name, "private"
+            )
+            user_access_status_by_lab[lab_short_name] = USER_ACCESS_STATUS_MATRIX[
+                lab_country_status
+            ][lab_accessibility]
+
+        # Remove expired rules
+        if rule.active_window and not (
+            rule.active_window[0] <= now <= rule.active_window[1]
+        ):
+            continue
+
+        rules_by_lab.setdefault(lab_short_name, []).append(rule)
+
+    lab_access = {}
+    for lab_short_name in sorted(rules_by_lab):
+        resolved = _resolve_lab(
+            rules_by_lab[lab_short_name], user_access_status_by_lab[lab_short_name]
+        )
+        if resolved is None:
+            continue
+
+        lab_access[lab_short_name] = {
+            "lab_profiles": resolved["lab_profiles"],
+            "lab_country_status": lab_country_statuses[lab_short_name],
+            "can_user_access_lab": resolved["can_user_access_lab"],
+            "can_user_see_lab_card": resolved["can_user_see_lab_card"],
+            "time_quota": None,
+        }
+
+    return lab_access
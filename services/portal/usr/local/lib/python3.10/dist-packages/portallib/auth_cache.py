@@ -0,0 +1,98 @@
+"""
+Per-user cache of the resolved auth data served by /portal/hub/auth.
+
+Entries live for a short TTL and are dropped early whenever something that feeds them changes:
+access rows, profile or geolocation (via useretc) and MFA or authorization status (via nativeauthenticator).
+"""
+
+import os
+import time
+import logging
+
+AUTH_CACHE_TTL_SECONDS = float(os.environ.get("PORTAL_AUTH_CACHE_TTL_SECONDS", 30))
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get("PORTAL_AUTH_CACHE_MAX_ENTRIES", 10000))
+
+
+class AuthCache:
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        # username => (expires at, data)
+        self._entries = {}
+
+        # Bumped by every invalidation so data loaded across one is never stored
+        self._version = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, username: str):
+        """
+        Cached data for the user, or None. The data is shared and must not be modified.
+        """
+        entry = self._entries.get(username)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        return None
+
+    def version(self) -> int:
+        """
+        Take before loading data and pass to `set` so data that was invalidated while loading is dropped.
+        """
+        return self._version
+
+    def set(self, username: str, data: dict, version: int) -> None:
+        if self.ttl_seconds <= 0 or version != self._version:
+            return
+
+        if len(self._entries) >= self.max_entries:
+            self._evict()
+
+        self._entries.pop(username, None)
+        self._entries[username] = (time.monotonic() + self.ttl_seconds, data)
+
+    def invalidate(self, usernames: list = None) -> None:
+        """
+        Drop the given users, or everyone if None.
+        """
+        self._version += 1
+        self.invalidations += 1
+
+        if usernames is None:
+            self._entries.clear()
+        else:
+            for username in usernames:
+                self._entries.pop(username, None)
+
+        logging.info(
+            f"Auth cache: invalidated {usernames if usernames is not None else 'all users'}"
+        )
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for username in [u for u, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[username]
+
+        # Still full, so drop the oldest half. Entries are kept in insertion order.
+        if len(self._entries) >= self.max_entries:
+            for username in list(self._entries)[: len(self._entries) // 2 + 1]:
+                del self._entries[username]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "invalidations": self.invalidations,
+            "entries": len(self._entries),
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+
+auth_cache = AuthCache(AUTH_CACHE_TTL_SECONDS, AUTH_CACHE_MAX_ENTRIES)
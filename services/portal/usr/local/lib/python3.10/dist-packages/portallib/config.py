@@ -0,0 +1,96 @@
+"""
+Process-wide portal config.
+
+labs.yaml and the hub tokens are read once and then only re-read when their file mtime changes,
+so handlers can ask for them on every request without touching the disk beyond a stat.
+"""
+
+import os
+import logging
+
+import yaml
+
+from portallib import access_rules
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+LABS_CONFIG_PATH = "/usr/local/etc/labs.yaml"
+HUB_RO_TOKEN_PATH = "/usr/local/secrets/portal-user-ro-token"
+HUB_W_TOKEN_PATH = "/usr/local/secrets/portal-user-w-token"
+
+
+class LabsConfig:
+    """
+    Parsed labs.yaml with the per-lab lookups the portal needs precomputed.
+    """
+
+    def __init__(self, config: dict):
+        self.raw: dict = config or {}
+        self.labs: list = self.raw.get("labs", []) or []
+
+        self.labs_by_short_name: dict = {lab.get("short_name"): lab for lab in self.labs}
+        self.lab_short_names: list = [lab.get("short_name") for lab in self.labs]
+
+        self.lab_enabled: dict = {
+            lab.get("short_name"): lab.get("enabled", True) for lab in self.labs
+        }
+        self.lab_accessibility: dict = {
+            lab.get("short_name"): lab.get("accessibility", "private")
+            for lab in self.labs
+        }
+        self.lab_ip_country_status: dict = {
+            lab.get("short_name"): lab.get("ip_country_status") or {}
+            for lab in self.labs
+        }
+        self.portal_ip_country_status: dict = self.raw.get("ip_country_status") or {}
+
+        # Effective lab country statuses for every configured country code, so an auth request is one lookup
+        (
+            self.country_status_table,
+            self.default_lab_country_statuses,
+        ) = access_rules.compile_country_status_table(
+            self.portal_ip_country_status, self.lab_ip_country_status
+        )
+
+
+class _FileCache:
+    """
+    Holds the parsed content of a file, re-parsing it only when the file's mtime changes.
+    """
+
+    def __init__(self, path: str, parse):
+        self.path = path
+        self.parse = parse
+        self._mtime = None
+        self._value = None
+
+    def get(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self._mtime:
+            with open(self.path, "r") as f:
+                self._value = self.parse(f)
+            self._mtime = mtime
+            logging.info(f"Portal config: loaded {self.path}")
+        return self._value
+
+
+_labs_config = _FileCache(
+    LABS_CONFIG_PATH, lambda f: LabsConfig(yaml.load(f, Loader=SafeLoader))
+)
+_hub_ro_token = _FileCache(HUB_RO_TOKEN_PATH, lambda f: f.read())
+_hub_w_token = _FileCache(HUB_W_TOKEN_PATH, lambda f: f.read())
+
+
+def get_labs_config() -> LabsConfig:
+    return _labs_config.get()
+
+
+def get_hub_ro_token() -> str:
+    return _hub_ro_token.get()
+
+
+def get_hub_w_token() -> str:
+    return _hub_w_token.get()
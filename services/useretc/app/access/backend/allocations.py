@@ -0,0 +1,126 @@
+"""
+Monthly credit allocations (`time_quota`) resolved straight from the access sheets.
+
+A lab's sheet is parsed once into per-username entries and cached by the lab's revision (see `AccessRevision`).
+Saving the sheet bumps the revision, so the next lookup re-parses it.
+
+The usernames are resolved the same way as by the portal when it works out lab access:
+
+    '!!'          Nobody has access to the lab and so nobody has an allocation
+    '!{username}' The user has no access to the lab
+    '!*'          The '*' rows are ignored
+    '*'           Applies to everyone
+    '{username}'  Applies to the user
+
+Rows outside their `active_till_dates` are ignored.
+If the user's own rows give a time quota, the largest of them is used. Otherwise, the largest from the '*' rows.
+"""
+
+import datetime
+import threading
+
+from app.utils.logging import log
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+ALWAYS_ACTIVE = (
+    datetime.datetime.min.replace(tzinfo=datetime.timezone.utc),
+    datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)
+)
+
+def _to_utc(value: str, default: str) -> datetime.datetime:
+    dt = datetime.datetime.fromisoformat(value or default)
+    if not dt.tzinfo:
+        dt = dt.astimezone(datetime.timezone.utc)
+    return dt
+
+def _parse_active_till_dates(active_till_dates: str) -> tuple:
+    """
+    Parse `start => end`, or just `end`, into aware datetimes. Same as the portal, malformed values never expire the row.
+
+    return: (start, end)
+    """
+    if not active_till_dates or str(active_till_dates).strip() == 'None':
+        return ALWAYS_ACTIVE
+
+    dates = [date.replace('"', '').replace("'", '').strip() for date in str(active_till_dates).split('=>')]
+    if len(dates) == 1:
+        dates = ['', dates[0]]
+    if len(dates) != 2:
+        log.error(f"More than one ' => ' found in Active Till Dates '{active_till_dates}'. Ignoring....")
+        return ALWAYS_ACTIVE
+
+    try:
+        start = _to_utc(dates[0], '1900-01-01')
+        end = _to_utc(dates[1], '2626-01-01')
+    except ValueError as e:
+        log.error(f"Something went wrong with parsing Active Till Dates '{active_till_dates}': {e}. Ignoring...")
+        return ALWAYS_ACTIVE
+
+    if start > end:
+        log.error(f"Date 1 ({start}) is greater than Date 2 ({end}). This is not possible. Ignoring...")
+        return ALWAYS_ACTIVE
+
+    return start, end
+
+def _parse_time_quota(time_quota) -> float:
+    if time_quota is None or str(time_quota).strip() in ('', 'None'):
+        return None
+    try:
+        return float(time_quota)
+    except ValueError:
+        return None
+
+def compile_lab_allocations(rows: list) -> dict:
+    """
+    rows: access sheet rows of one lab with `username`, `active_till_dates` and `time_quota`
+
+    return: {username: [(start, end, time_quota), ...]}
+    """
+    allocations = {}
+    for row in rows:
+        username = str(row.get('username') or '').strip()
+        if not username:
+            continue
+        start, end = _parse_active_till_dates(row.get('active_till_dates'))
+        allocations.setdefault(username, []).append((start, end, _parse_time_quota(row.get('time_quota'))))
+    return allocations
+
+def resolve_time_quota(allocations: dict, username: str, now: datetime.datetime=None) -> float:
+    """
+    The user's monthly credit allocation in the lab, or None if there is none.
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    def active_entries(name):
+        return [entry for entry in allocations.get(name, []) if entry[0] <= now <= entry[1]]
+
+    if active_entries('!!') or active_entries(f"!{username}"):
+        return None
+
+    for name in [username] if active_entries('!*') else [username, '*']:
+        time_quotas = [time_quota for _, _, time_quota in active_entries(name) if time_quota is not None]
+        if time_quotas:
+            return max(time_quotas)
+
+    return None
+
+def get_cached(lab_short_name: str, revision: int) -> dict:
+    with _cache_lock:
+        cached = _cache.get(lab_short_name, None)
+    if cached and cached[0] == revision:
+        return cached[1]
+    return None
+
+def set_cached(lab_short_name: str, revision: int, allocations: dict) -> None:
+    with _cache_lock:
+        _cache[lab_short_name] = (revision, allocations)
+
+def invalidate(lab_short_name: str=None) -> None:
+    with _cache_lock:
+        if lab_short_name is None:
+            _cache.clear()
+        else:
+            _cache.pop(lab_short_name, None)
@@ -1,14 +1,21 @@
 
 import math
+from collections import defaultdict
 
 from sqlalchemy.orm import Session
 
 from app.utils.logging import log
-from app.database.utils import convert_to_dict
-from app.database.schema import Access
+from app.database.utils import convert_to_dict, upsert
+from app.database.get_db import run_in_db_executor
+from app.database.schema import Access, AccessRevision
+from . import allocations
 
-async def get_data_for_lab(lab_short_name: str, db: Session) -> list:
-    records = db.query(
+SHEET_FIELDS = ['username', 'lab_profiles', 'active_till_dates', 'time_quota', 'comments']
+
+def _get_rows_changed_since(lab_short_name: str, since_version: int, db: Session) -> list:
+    query = db.query(
+            Access.row_id,
+            Access.version,
             Access.username,
             Access.lab_profiles,
             Access.active_till_dates,
@@ -16,7 +23,12 @@ async def get_data_for_lab(lab_short_name: str, db: Session) -> list:
             Access.comments
         ).filter(
             Access.lab_short_name == lab_short_name
-        ).order_by(
+        )
+
+    if since_version:
+        query = query.filter(Access.version > since_version)
+
+    records = query.order_by(
             Access.row_id
         ).all()
 
@@ -24,7 +36,17 @@ async def get_data_for_lab(lab_short_name: str, db: Session) -> list:
         return []
     return [convert_to_dict(record) for record in records]
 
-async def get_data_for_username(username: str, db: Session) -> list:
+@run_in_db_executor
+def get_data_for_lab(lab_short_name: str, db: Session, since_version: int=None) -> list:
+    """
+    Rows of the lab's access sheet, ordered by row_id. If `since_version` is given, only rows changed after that lab revision.
+    """
+    return _get_rows_changed_since(lab_short_name, since_version, db)
+
+def _get_data_for_usernames(usernames: list, db: Session) -> list:
+    """
+    Access rows for all given usernames in one query, grouped in the order the usernames were given.
+    """
     records = db.query(
             Access.lab_short_name,
             Access.username,
@@ -34,7 +56,7 @@ async def get_data_for_username(username: str, db: Session) -> list:
             Access.time_quota,
             Access.comments
         ).filter(
-            Access.username == username
+            Access.username.in_(usernames)
         ).order_by(
             Access.lab_short_name,
             Access.row_id,
@@ -43,9 +65,21 @@ async def get_data_for_username(username: str, db: Session) -> list:
 
     if not records:
         return []
+
+    username_order = {username: i for i, username in enumerate(usernames)}
+    records.sort(key=lambda record: username_order[record.username])
     return [convert_to_dict(record) for record in records]
 
-async def get_lab_short_names(db: Session) -> list:
+@run_in_db_executor
+def get_data_for_username(username: str, db: Session) -> list:
+    return _get_data_for_usernames([username], db)
+
+@run_in_db_executor
+def get_data_for_usernames(usernames: list, db: Session) -> list:
+    return _get_data_for_usernames(usernames, db)
+
+@run_in_db_executor
+def get_lab_short_names(db: Session) -> list:
     records = db.query(
             Access.lab_short_name
         ).group_by(
@@ -56,42 +90,138 @@ async def get_lab_short_names(db: Session) -> list:
         return []
     return [convert_to_dict(record)['lab_short_name'] for record in records]
 
-async def update_data_for_lab(lab_short_name: str, data: list, db: Session) -> None:
+def _bump_lab_revision(lab_short_name: str, db: Session) -> int:
+    """
+    Increment and return the lab's revision. This is the first write of a save, so it holds the lab's write lock until commit.
+    """
+    upsert(
+        db,
+        AccessRevision,
+        [{'lab_short_name': lab_short_name, 'revision': 1}],
+        index_elements=['lab_short_name'],
+        increment_columns=['revision']
+    )
+
+    return db.query(AccessRevision.revision).filter(AccessRevision.lab_short_name == lab_short_name).scalar()
+
+@run_in_db_executor
+def update_data_for_lab(lab_short_name: str, data: list, db: Session, since_version: int=None) -> dict:
+    """
+    Save changed rows of a lab's access sheet within one transaction.
+
+    data: [{'row': row_id, 'version': int, 'data': {field: value}}]
+
+        If 'version' is given, the row is only saved if it is still at that version in the DB (0 for a new row). Otherwise, it is reported as a conflict.
+        If 'version' is not given, the row is always saved.
+
+    since_version: The latest lab revision the client has seen. Rows changed after it are returned. If not given, only the rows saved now are returned.
+
+    return: {
+        'version': int,  # Latest lab revision
+        'rows': list,  # Rows changed since `since_version`, including the ones just saved
+        'conflicts': list[int]  # row_ids that were not saved since they were changed by someone else
+    }
+    """
+
     # For lab_short_name, if exists update. Otherwise, insert
     # For row -> row_id, if exists update. Otherwise, insert.
     # For other fields, always update according to row_id and lab_short_name
-    for row in data:
-        row_id = row['row']
-        row_data = row['data']
-
-        row_exists = db.query(Access).filter(
-                Access.lab_short_name == lab_short_name,
-                Access.row_id == row_id
-            ).first() is not None
-
-        if row_exists:
-
-            # Delete row if all data is gone
-            if not row['data'].get('lab_profile', math.inf) and \
-                not row['data'].get('username', math.inf) and \
-                not row['data'].get('time_quota', math.inf):
-                pass
-                #db.query(Access).filter(
-                #    Access.lab_short_name == lab_short_name,
-                #    Access.row_id == row_id
-                #).delete()
-
-            # update
-            else:
-                db.query(Access).filter(
-                        Access.lab_short_name == lab_short_name,
-                        Access.row_id == row_id
-                    ).update(row_data)
-                db.commit()
-
-        else:
-            # insert
-            db_entry = Access(lab_short_name=lab_short_name, row_id=row_id, **row_data)
-            db.add(db_entry)
-            db.commit()
-            db.refresh(db_entry)
+    # All rows are saved within one transaction. Rows are upserted in bulk, grouped by which fields were given.
+
+    conflicts = []
+    try:
+        revision = _bump_lab_revision(lab_short_name, db)
+
+        existing_row_versions = dict(
+            db.query(
+                Access.row_id,
+                Access.version
+            ).filter(
+                Access.lab_short_name == lab_short_name
+            ).all()
+        )
+
+        rows_by_fields = defaultdict(list)
+        for row in data:
+            row_id = row['row']
+            row_data = {key: value for key, value in row['data'].items() if key in SHEET_FIELDS}
+
+            if 'version' in row:
+                client_version = int(row['version'] or 0)
+                server_version = int(existing_row_versions.get(row_id, 0) or 0)
+                if client_version != server_version:
+                    log.warning(f"Access sheet conflict for lab {lab_short_name}, row {row_id}: client version {client_version}, server version {server_version}")
+                    conflicts.append(row_id)
+                    continue
+
+            if row_id in existing_row_versions:
+
+                # Delete row if all data is gone
+                if not row['data'].get('lab_profile', math.inf) and \
+                    not row['data'].get('username', math.inf) and \
+                    not row['data'].get('time_quota', math.inf):
+                    continue
+                    #db.query(Access).filter(
+                    #    Access.lab_short_name == lab_short_name,
+                    #    Access.row_id == row_id
+                    #).delete()
+
+            fields = tuple(sorted(row_data.keys()))
+            rows_by_fields[fields].append({'lab_short_name': lab_short_name, 'row_id': row_id, 'version': revision, **row_data})
+
+        for fields, rows in rows_by_fields.items():
+            upsert(
+                db,
+                Access,
+                rows,
+                index_elements=['lab_short_name', 'row_id'],
+                update_columns=list(fields) + ['version']
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    allocations.invalidate(lab_short_name)
+
+    if since_version is None:
+        since_version = revision - 1
+
+    return {
+        'version': revision,
+        'rows': _get_rows_changed_since(lab_short_name, since_version, db),
+        'conflicts': conflicts
+    }
+
+def _get_lab_allocations(lab_short_name: str, db: Session) -> dict:
+    revision = db.query(AccessRevision.revision).filter(AccessRevision.lab_short_name == lab_short_name).scalar() or 0
+
+    lab_allocations = allocations.get_cached(lab_short_name, revision)
+    if lab_allocations is None:
+        records = db.query(
+                Access.username,
+                Access.active_till_dates,
+                Access.time_quota
+            ).filter(
+                Access.lab_short_name == lab_short_name
+            ).all()
+        lab_allocations = allocations.compile_lab_allocations([convert_to_dict(record) for record in records])
+        allocations.set_cached(lab_short_name, revision, lab_allocations)
+
+    return lab_allocations
+
+@run_in_db_executor
+def get_time_quotas_for_pairs(pairs: list, db: Session) -> dict:
+    """
+    Monthly credit allocations from the access sheets. See `allocations.py` for how usernames are resolved.
+
+    pairs: list of (username, lab_short_name)
+
+    return: {(username, lab_short_name): float or None}
+    """
+    lab_allocations = {lab_short_name: _get_lab_allocations(lab_short_name, db) for lab_short_name in {lab for _, lab in pairs}}
+
+    return {
+        (username, lab_short_name): allocations.resolve_time_quota(lab_allocations[lab_short_name], username)
+        for username, lab_short_name in pairs
+    }
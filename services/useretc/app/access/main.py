@@ -12,6 +12,7 @@ from sqlalchemy.orm import Session
 from jinja2 import Environment, FileSystemLoader
 
 from .backend import crud
+from app.utils import helps
 from app.utils.decorator import user_type
 from app.utils.logging import log
 from app.database.get_db import get_db
@@ -60,19 +61,66 @@ async def get_user_access_admin_page(request: Request, db_session: Session = Dep
 
 @router.get('/lab/{lab_short_name}')
 @user_type('admin')
-async def get_user_access_data_by_lab(request: Request, lab_short_name: str, db_session: Session = Depends(get_db)) -> list:
+async def get_user_access_data_by_lab(request: Request, lab_short_name: str, since_version: int=None, db_session: Session = Depends(get_db)) -> list:
+    """
+    Rows of the lab's access sheet, each with its `row_id` and `version`.
+    If `since_version` is given, only rows changed after that lab revision.
+    """
     lab_short_name = unquote(lab_short_name)
-    data = await crud.get_data_for_lab(lab_short_name, db=db_session)
+    data = await crud.get_data_for_lab(lab_short_name, db=db_session, since_version=since_version)
     return data
 
 @router.post('/lab/{lab_short_name}')
 @user_type('admin')
-async def post_user_access_data_by_lab(request: Request, lab_short_name: str, db_session: Session = Depends(get_db)) -> None:
+async def post_user_access_data_by_lab(request: Request, lab_short_name: str, db_session: Session = Depends(get_db)) -> dict:
+    """
+    Save only the edited rows of the lab's access sheet.
+
+    JSON body:
+        {
+            'since_version': int,  # Latest lab revision the sheet has seen
+            'changes': [
+                {'row': row_id, 'version': int, 'data': {field: value}}
+            ]
+        }
+
+    Rows whose version no longer matches the DB were edited by someone else and are not saved.
+    Returns the latest lab revision, any rows changed since `since_version` and the row_ids in conflict.
+
+    For older clients, a form field `data` holding a list of rows without versions is saved unconditionally.
+    """
     lab_short_name = unquote(lab_short_name)
-    form = await request.form()
-    data = json.loads(dict(form)['data'])
-    await crud.update_data_for_lab(lab_short_name, data, db=db_session)
-    return
+
+    if request.headers.get('content-type', '').startswith('application/json'):
+        body = await request.json()
+        result = await crud.update_data_for_lab(
+            lab_short_name,
+            body.get('changes', []),
+            db=db_session,
+            since_version=body.get('since_version', 0)
+        )
+
+    else:
+        form = await request.form()
+        data = json.loads(dict(form)['data'])
+        result = await crud.update_data_for_lab(lab_short_name, data, db=db_session)
+
+    # Rows for '*', '!*' or '!!', or rows moved between usernames, can change anyone's access.
+    # Drop the cached access once the rows are saved so the next page load sees them.
+    await helps.invalidate_portal_auth_cache()
+
+    return result
+
+@router.get('/username')
+async def get_user_access_data_by_usernames(request: Request, db_session: Session = Depends(get_db)) -> str:
+    """
+    Access rows for several usernames in one query, e.g. `/access/username?username=jdoe&username=!jdoe&username=*`
+
+    Rows are grouped in the order the usernames were given.
+    """
+    usernames = list(dict.fromkeys(request.query_params.getlist('username')))
+    user_data = await crud.get_data_for_usernames(usernames, db=db_session)
+    return encryptedjwt.encrypt(user_data)
 
 @router.get('/username/{username}')
 async def get_user_access_data_by_username(request: Request, username: str, db_session: Session = Depends(get_db)) -> str:
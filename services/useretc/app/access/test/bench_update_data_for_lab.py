@@ -0,0 +1,72 @@
+"""
+Benchmark saving access sheets with `crud.update_data_for_lab`.
+
+Saves a new sheet of N rows (all inserts) and then saves it again (all updates) against a scratch SQLite DB.
+For comparison, the previous row-by-row save (SELECT, then UPDATE or INSERT, then commit per row) is also timed.
+
+From within the app directory:
+
+    python access/test/bench_update_data_for_lab.py [number_of_rows]
+"""
+
+import os
+import sys
+import time
+import pathlib
+import asyncio
+import tempfile
+
+tmp_dir = tempfile.mkdtemp()
+os.environ['USERETC_DATABASE_URL'] = f"sqlite:///{tmp_dir}/bench.db"
+sys.path.append(str(pathlib.Path(__file__).parents[3]))
+
+from app.database.schema import SessionLocal, Access
+from app.access.backend import crud
+
+num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+def make_sheet(num_rows: int, version: str) -> list:
+    return [
+        {
+            'row': row_id,
+            'data': {
+                'username': f"user{row_id}",
+                'lab_profiles': f"SAR {version}, Debug",
+                'active_till_dates': '2020-01-01 => 2626-01-01',
+                'time_quota': '40',
+                'comments': f"Row {row_id} {version}"
+            }
+        } for row_id in range(num_rows)
+    ]
+
+def row_by_row_save(lab_short_name: str, data: list, db) -> None:
+    for row in data:
+        row_id = row['row']
+        row_data = row['data']
+        row_exists = db.query(Access).filter(
+                Access.lab_short_name == lab_short_name,
+                Access.row_id == row_id
+            ).first() is not None
+        if row_exists:
+            db.query(Access).filter(
+                    Access.lab_short_name == lab_short_name,
+                    Access.row_id == row_id
+                ).update(row_data)
+            db.commit()
+        else:
+            db.add(Access(lab_short_name=lab_short_name, row_id=row_id, **row_data))
+            db.commit()
+
+def timed(label: str, func, *args) -> None:
+    start = time.perf_counter()
+    func(*args)
+    print(f"{label:<40} {time.perf_counter() - start:8.3f} s")
+
+print(f"Saving a sheet of {num_rows} rows")
+
+db = SessionLocal()
+timed("bulk upsert: insert sheet", lambda: asyncio.run(crud.update_data_for_lab('bench-bulk', make_sheet(num_rows, 'A'), db=db)))
+timed("bulk upsert: update sheet", lambda: asyncio.run(crud.update_data_for_lab('bench-bulk', make_sheet(num_rows, 'B'), db=db)))
+timed("row by row: insert sheet", row_by_row_save, 'bench-row', make_sheet(num_rows, 'A'), db)
+timed("row by row: update sheet", row_by_row_save, 'bench-row', make_sheet(num_rows, 'B'), db)
+db.close()
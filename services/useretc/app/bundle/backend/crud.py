@@ -0,0 +1,20 @@
+from sqlalchemy.orm import Session
+
+from app.database.get_db import run_in_db_executor
+from profile import crud as profile_crud
+from geolocation.backend import crud as geolocation_crud
+from access.backend import crud as access_crud
+
+def access_usernames_for(username: str) -> list:
+    """
+    Access usernames that can affect the given user, in the order the portal resolves them.
+    """
+    return [username, f"!{username}", "*", "!*", "!!"]
+
+@run_in_db_executor
+def get_bundle_for_username(username: str, db: Session) -> dict:
+    return {
+        'profile': profile_crud._get_profile_by_username(db, username),
+        'geolocation': geolocation_crud._get_latest_geodata_for_username(username, db),
+        'access': access_crud._get_data_for_usernames(access_usernames_for(username), db)
+    }
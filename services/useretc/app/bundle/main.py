@@ -0,0 +1,22 @@
+from urllib.parse import unquote
+
+from fastapi import APIRouter, Request, Depends
+from sqlalchemy.orm import Session
+
+from .backend import crud
+from app.database.get_db import get_db
+from opensarlab.auth import encryptedjwt
+
+router = APIRouter(
+    prefix="/bundle",
+)
+
+@router.get('/username/{username}')
+async def get_user_bundle(request: Request, username: str, db_session: Session = Depends(get_db)) -> str:
+    """
+    Everything the portal needs to resolve a user's auth data, read in one DB session:
+    the raw profile, the latest geolocation and the access rows for username, !username, *, !* and !!.
+    """
+    username = unquote(username)
+    data = await crud.get_bundle_for_username(username, db=db_session)
+    return encryptedjwt.encrypt(data)
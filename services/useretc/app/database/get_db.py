@@ -1,7 +1,22 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
 from app.database import schema
+from app.database import migrate
+from app.database.config import db_config
+
+# Create or upgrade the DB on startup
+migrate.upgrade(schema.engine)
+
+# Max number of DB calls that can run at the same time.
+# Keep this below the engine's connection pool size so workers never wait on a connection.
+DB_EXECUTOR_MAX_WORKERS = db_config['executor_max_workers']
 
-#database.Base.metadata.drop_all(bind=engine)
-schema.Base.metadata.create_all(bind=schema.engine)
+db_executor = ThreadPoolExecutor(
+    max_workers=DB_EXECUTOR_MAX_WORKERS,
+    thread_name_prefix="useretc-db"
+)
 
 # Dependency
 def get_db():
@@ -9,4 +24,16 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+def run_in_db_executor(func):
+    """
+    Decorator. Run a synchronous DB function within the bounded DB thread pool so it does not block the event loop.
+
+    The wrapped function becomes awaitable: `records = await crud.some_query(db=db_session)`
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+    return wrapper
@@ -0,0 +1,71 @@
+"""
+Apply versioned schema migrations to the useretc DB.
+
+The current version of the DB is kept in the `schema_version` table.
+New DBs are created straight from the models in `schema.py` and marked as being at the latest version.
+Existing DBs have any missing tables created and then each pending migration applied, in order, within its own transaction.
+
+This is run on startup. To upgrade a DB file by hand, from within the app directory:
+
+    python -m database.migrate
+"""
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, select
+
+from app.database import schema
+from app.database.migrations import MIGRATIONS, LATEST_VERSION
+from app.utils.logging import log
+
+metadata = MetaData()
+
+schema_version = Table(
+    'schema_version',
+    metadata,
+    Column('version', Integer, nullable=False)
+)
+
+def get_schema_version(connection) -> int:
+    if not inspect(connection).has_table('schema_version'):
+        return 0
+    version = connection.execute(select(schema_version.c.version)).scalar()
+    return version or 0
+
+def _set_schema_version(connection, version: int) -> None:
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+
+def upgrade(engine=schema.engine) -> int:
+    """
+    Bring the DB up to the latest version. Returns the resulting version.
+    """
+
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        is_new_db = not any(inspector.has_table(table_name) for table_name in schema.Base.metadata.tables)
+
+        # Only tables that are missing are created
+        schema.Base.metadata.create_all(bind=connection)
+        metadata.create_all(bind=connection)
+
+        if is_new_db:
+            log.info(f"New DB created at schema version {LATEST_VERSION}")
+            _set_schema_version(connection, LATEST_VERSION)
+            return LATEST_VERSION
+
+        current_version = get_schema_version(connection)
+
+    for migration in MIGRATIONS:
+        if migration.VERSION <= current_version:
+            continue
+
+        log.warning(f"Migrating DB from schema version {current_version} to {migration.VERSION}: {migration.__name__}")
+        with engine.begin() as connection:
+            migration.upgrade(connection)
+            _set_schema_version(connection, migration.VERSION)
+        current_version = migration.VERSION
+
+    return current_version
+
+if __name__ == "__main__":
+    version = upgrade()
+    print(f"DB is at schema version {version}")
@@ -0,0 +1,40 @@
+"""
+Versioned migrations for the useretc DB. See `database/migrate.py`.
+
+To add a migration, create a new module `vNNNN_short_description.py` with an increasing `VERSION` and an `upgrade(connection)` function.
+Then add it to MIGRATIONS below. Migrations should be safe to re-run since new DBs are created straight from `schema.py`.
+"""
+
+from . import v0001_legacy_columns
+from . import v0002_lookup_indexes
+from . import v0003_quota_typed_columns
+from . import v0004_access_versions
+from . import v0005_query_indexes
+from . import v0006_geolocation_history
+from . import v0007_geolocation_unique_username
+from . import v0008_quota_ledger
+from . import v0009_quota_usage_daily
+from . import v0010_quota_reaper
+from . import v0011_quota_unique_spawner
+
+MIGRATIONS = sorted(
+    [
+        v0001_legacy_columns,
+        v0002_lookup_indexes,
+        v0003_quota_typed_columns,
+        v0004_access_versions,
+        v0005_query_indexes,
+        v0006_geolocation_history,
+        v0007_geolocation_unique_username,
+        v0008_quota_ledger,
+        v0009_quota_usage_daily,
+        v0010_quota_reaper,
+        v0011_quota_unique_spawner,
+    ],
+    key=lambda migration: migration.VERSION
+)
+
+if len({migration.VERSION for migration in MIGRATIONS}) != len(MIGRATIONS):
+    raise Exception("Migration versions must be unique")
+
+LATEST_VERSION = MIGRATIONS[-1].VERSION if MIGRATIONS else 0
@@ -0,0 +1,25 @@
+"""
+Small helpers shared by the migrations. Each is a no-op if the change is already present.
+"""
+
+from sqlalchemy import inspect, text
+
+def has_table(connection, table_name: str) -> bool:
+    return inspect(connection).has_table(table_name)
+
+def has_column(connection, table_name: str, column_name: str) -> bool:
+    return column_name in [column['name'] for column in inspect(connection).get_columns(table_name)]
+
+def add_column(connection, table_name: str, column_name: str, column_type: str) -> None:
+    if not has_column(connection, table_name, column_name):
+        connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}"))
+
+def has_index(connection, table_name: str, index_name: str) -> bool:
+    return index_name in [index['name'] for index in inspect(connection).get_indexes(table_name)]
+
+def create_index(connection, index_name: str, table_name: str, columns: list, unique: bool=False) -> None:
+    unique_str = "UNIQUE " if unique else ""
+    connection.execute(text(f"CREATE {unique_str}INDEX IF NOT EXISTS {index_name} ON {table_name} ({', '.join(columns)})"))
+
+def drop_index(connection, index_name: str) -> None:
+    connection.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
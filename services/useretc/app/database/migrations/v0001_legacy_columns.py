@@ -0,0 +1,26 @@
+"""
+Columns that were previously added by hand with `ALTER TABLE`.
+"""
+
+from .utils import add_column
+
+VERSION = 1
+
+def upgrade(connection) -> None:
+    add_column(connection, 'access', 'active_till_dates', 'VARCHAR')
+
+    for column_name in [
+            'is_affliated_with_nasa_research',
+            'has_affliated_with_nasa_research_email',
+            'user_affliated_with_nasa_research_email',
+            'pi_affliated_with_nasa_research_email',
+            'is_affliated_with_gov_research',
+            'user_affliated_with_gov_research_email',
+            'is_affliated_with_isro_research',
+            'user_affliated_with_isro_research_email',
+            'is_affliated_with_university',
+            'faculty_member_affliated_with_university',
+            'research_member_affliated_with_university',
+            'graduate_student_affliated_with_university'
+        ]:
+        add_column(connection, 'profile', column_name, 'VARCHAR')
@@ -0,0 +1,30 @@
+"""
+Indexes for the hot lookups:
+
+    Access by (lab_short_name, row_id) and by username
+    Quota by (username, lab_short_name, start_time) and by spawner_instance_id
+    GeoLocation by username
+
+Access rows are keyed by (lab_short_name, row_id). Any duplicates are removed, keeping the newest row, before the unique index is made.
+"""
+
+from sqlalchemy import text
+
+from .utils import create_index
+
+VERSION = 2
+
+def upgrade(connection) -> None:
+    connection.execute(text("""
+        DELETE FROM access
+        WHERE id NOT IN (
+            SELECT MAX(id) FROM access GROUP BY lab_short_name, row_id
+        )
+    """))
+    create_index(connection, 'ix_access_lab_short_name_row_id', 'access', ['lab_short_name', 'row_id'], unique=True)
+    create_index(connection, 'ix_access_username', 'access', ['username'])
+
+    create_index(connection, 'ix_quota_username_lab_short_name_start_time', 'quota', ['username', 'lab_short_name', 'start_time'])
+    create_index(connection, 'ix_quota_spawner_instance_id', 'quota', ['spawner_instance_id'])
+
+    create_index(connection, 'ix_geolocation_username', 'geolocation', ['username'])
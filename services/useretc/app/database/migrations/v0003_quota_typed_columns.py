@@ -0,0 +1,70 @@
+"""
+Quota `cpu_hour`, `start_time` and `stop_time` were String columns. Convert them to Float and DateTime.
+
+SQLite can't change the type of a column, so the table is rebuilt and the existing rows are backfilled with converted values.
+Values that can't be parsed are logged and stored as NULL.
+"""
+
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, String, Table, inspect, text
+
+from app.database.utils import to_datetime
+from app.utils.logging import log
+from .utils import create_index
+
+VERSION = 3
+
+BATCH_SIZE = 5000
+
+metadata = MetaData()
+
+quota_new = Table(
+    'quota_new',
+    metadata,
+    Column('id', Integer, primary_key=True),
+    Column('spawner_instance_id', String),
+    Column('lab_short_name', String),
+    Column('username', String),
+    Column('profile_name', String),
+    Column('cpu_hour', Float),
+    Column('start_time', DateTime),
+    Column('stop_time', DateTime),
+)
+
+def _to_float(value) -> float:
+    if value is None or str(value).strip() in ('', 'None'):
+        return None
+    return float(value)
+
+def _convert(row: dict) -> dict:
+    row = dict(row)
+    for key, convert in [('cpu_hour', _to_float), ('start_time', to_datetime), ('stop_time', to_datetime)]:
+        try:
+            row[key] = convert(row[key])
+        except Exception as e:
+            log.error(f"Quota row {row['id']}: could not convert {key} value '{row[key]}'. Setting to NULL... {e}")
+            row[key] = None
+    return row
+
+def upgrade(connection) -> None:
+    columns = {column['name']: column['type'] for column in inspect(connection).get_columns('quota')}
+    if not isinstance(columns['start_time'], String):
+        return
+
+    quota_new.drop(connection, checkfirst=True)
+    quota_new.create(connection)
+
+    result = connection.execute(text(
+        "SELECT id, spawner_instance_id, lab_short_name, username, profile_name, cpu_hour, start_time, stop_time FROM quota"
+    ))
+    while True:
+        rows = result.mappings().fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        connection.execute(quota_new.insert(), [_convert(row) for row in rows])
+
+    connection.execute(text("DROP TABLE quota"))
+    connection.execute(text("ALTER TABLE quota_new RENAME TO quota"))
+
+    create_index(connection, 'ix_quota_id', 'quota', ['id'])
+    create_index(connection, 'ix_quota_username_lab_short_name_start_time', 'quota', ['username', 'lab_short_name', 'start_time'])
+    create_index(connection, 'ix_quota_spawner_instance_id', 'quota', ['spawner_instance_id'])
@@ -0,0 +1,24 @@
+"""
+Row versions for access sheets so that concurrent admin edits can be detected.
+
+Existing rows start at version 1 and each lab's revision is set to the highest version of its rows.
+"""
+
+from sqlalchemy import text
+
+from .utils import add_column, create_index
+
+VERSION = 4
+
+def upgrade(connection) -> None:
+    add_column(connection, 'access', 'version', 'INTEGER')
+    connection.execute(text("UPDATE access SET version = 1 WHERE version IS NULL"))
+    create_index(connection, 'ix_access_lab_short_name_version', 'access', ['lab_short_name', 'version'])
+
+    # The access_revision table is created from the models before migrations are run
+    connection.execute(text("""
+        INSERT INTO access_revision (lab_short_name, revision)
+        SELECT lab_short_name, MAX(version) FROM access
+        WHERE lab_short_name NOT IN (SELECT lab_short_name FROM access_revision)
+        GROUP BY lab_short_name
+    """))
@@ -0,0 +1,13 @@
+"""
+Indexes for the admin query API filters and sort keys.
+"""
+
+from .utils import create_index
+
+VERSION = 5
+
+def upgrade(connection) -> None:
+    create_index(connection, 'ix_profile_country_of_residence', 'profile', ['country_of_residence'])
+
+    create_index(connection, 'ix_geolocation_timestamp', 'geolocation', ['timestamp'])
+    create_index(connection, 'ix_geolocation_country_code_timestamp', 'geolocation', ['country_code', 'timestamp'])
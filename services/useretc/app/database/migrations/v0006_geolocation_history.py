@@ -0,0 +1,29 @@
+"""
+Seed the new geolocation history and per-user daily rollup tables with the latest location of each user.
+
+The tables themselves are created from `schema.py` before migrations run.
+"""
+
+from sqlalchemy import text
+
+VERSION = 6
+
+def upgrade(connection) -> None:
+    history_count = connection.execute(text("SELECT COUNT(*) FROM geolocation_history")).scalar()
+    if history_count:
+        return
+
+    connection.execute(text("""
+        INSERT INTO geolocation_history (username, ip_address, ip_country_status, country_code, timestamp)
+        SELECT username, ip_address, ip_country_status, country_code, timestamp
+        FROM geolocation
+        WHERE username IS NOT NULL AND timestamp IS NOT NULL
+    """))
+
+    connection.execute(text("""
+        INSERT INTO geolocation_daily_user (day, username, country_code, hits)
+        SELECT DATE(timestamp), username, COALESCE(country_code, ''), 1
+        FROM geolocation
+        WHERE username IS NOT NULL AND timestamp IS NOT NULL
+        GROUP BY DATE(timestamp), username, COALESCE(country_code, '')
+    """))
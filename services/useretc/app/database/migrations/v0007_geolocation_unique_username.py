@@ -0,0 +1,21 @@
+"""
+Make geolocation.username unique so that updates can be a single upsert.
+
+Any duplicate rows are removed first, keeping the newest row of each user.
+"""
+
+from sqlalchemy import text
+
+from .utils import create_index, drop_index
+
+VERSION = 7
+
+def upgrade(connection) -> None:
+    connection.execute(text("""
+        DELETE FROM geolocation
+        WHERE id NOT IN (
+            SELECT MAX(id) FROM geolocation GROUP BY username
+        )
+    """))
+    drop_index(connection, 'ix_geolocation_username')
+    create_index(connection, 'ix_geolocation_username', 'geolocation', ['username'], unique=True)
@@ -0,0 +1,58 @@
+"""
+Backfill the quota ledger from all stopped quota sessions and index open sessions by user and lab.
+
+The ledger table itself is created from `schema.py` before migrations run.
+"""
+
+from sqlalchemy import text
+
+from app.database.schema import QuotaLedger
+from app.database.utils import to_datetime
+from app.quota.backend.credits import split_hours_by_month
+from .utils import create_index
+
+VERSION = 8
+
+BATCH_SIZE = 5000
+
+def upgrade(connection) -> None:
+    create_index(connection, 'ix_quota_username_lab_short_name_stop_time', 'quota', ['username', 'lab_short_name', 'stop_time'])
+
+    if connection.execute(text("SELECT COUNT(*) FROM quota_ledger")).scalar():
+        return
+
+    backfill(connection)
+
+def backfill(connection) -> None:
+    ledger = {}
+    result = connection.execute(text(
+        "SELECT username, lab_short_name, cpu_hour, start_time, stop_time FROM quota WHERE stop_time IS NOT NULL"
+    ))
+    while True:
+        rows = result.mappings().fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            cpu_hour = row['cpu_hour'] or 0.0
+            start_time = to_datetime(row['start_time'])
+            for month, hours in split_hours_by_month(start_time, to_datetime(row['stop_time'])):
+                key = (row['username'], row['lab_short_name'], month)
+                entry = ledger.setdefault(key, {'credits_used': 0.0, 'hours': 0.0, 'last_start_time': None, 'last_cpu_hour': None})
+                entry['credits_used'] += hours * cpu_hour
+                entry['hours'] += hours
+                if entry['last_start_time'] is None or start_time >= entry['last_start_time']:
+                    entry['last_start_time'] = start_time
+                    entry['last_cpu_hour'] = cpu_hour
+
+    ledger_rows = [
+        {
+            'username': username,
+            'lab_short_name': lab_short_name,
+            'month': month,
+            'credits_used': entry['credits_used'],
+            'hours': entry['hours'],
+            'last_cpu_hour': entry['last_cpu_hour']
+        } for (username, lab_short_name, month), entry in ledger.items()
+    ]
+    for i in range(0, len(ledger_rows), BATCH_SIZE):
+        connection.execute(QuotaLedger.__table__.insert(), ledger_rows[i:i + BATCH_SIZE])
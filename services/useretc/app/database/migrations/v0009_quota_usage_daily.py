@@ -0,0 +1,50 @@
+"""
+Backfill the daily quota usage rollup from all stopped quota sessions.
+
+The rollup table itself is created from `schema.py` before migrations run.
+"""
+
+from sqlalchemy import text
+
+from app.database.schema import QuotaUsageDaily
+from app.database.utils import to_datetime
+from app.quota.backend.credits import split_hours_by_day
+
+VERSION = 9
+
+BATCH_SIZE = 5000
+
+def upgrade(connection) -> None:
+    if connection.execute(text("SELECT COUNT(*) FROM quota_usage_daily")).scalar():
+        return
+
+    backfill(connection)
+
+def backfill(connection) -> None:
+    usage = {}
+    result = connection.execute(text(
+        "SELECT username, lab_short_name, profile_name, cpu_hour, start_time, stop_time FROM quota WHERE stop_time IS NOT NULL"
+    ))
+    while True:
+        rows = result.mappings().fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            cpu_hour = row['cpu_hour'] or 0.0
+            for day, hours in split_hours_by_day(to_datetime(row['start_time']), to_datetime(row['stop_time'])):
+                key = (day, row['lab_short_name'] or '', row['profile_name'] or '', row['username'] or '')
+                entry = usage.setdefault(key, {'hours': 0.0, 'credits_used': 0.0})
+                entry['hours'] += hours
+                entry['credits_used'] += hours * cpu_hour
+
+    usage_rows = [
+        {
+            'day': day,
+            'lab_short_name': lab_short_name,
+            'profile_name': profile_name,
+            'username': username,
+            **entry
+        } for (day, lab_short_name, profile_name, username), entry in usage.items()
+    ]
+    for i in range(0, len(usage_rows), BATCH_SIZE):
+        connection.execute(QuotaUsageDaily.__table__.insert(), usage_rows[i:i + BATCH_SIZE])
@@ -0,0 +1,20 @@
+"""
+Quota heartbeat and close reason columns for the stale session reaper, and an index to find open sessions.
+
+Sessions that were already stopped are marked as stopped by the lab.
+"""
+
+from sqlalchemy import text
+
+from .utils import add_column, create_index
+
+VERSION = 10
+
+def upgrade(connection) -> None:
+    add_column(connection, 'quota', 'heartbeat_time', 'TIMESTAMP')
+    add_column(connection, 'quota', 'close_reason', 'VARCHAR')
+
+    connection.execute(text("UPDATE quota SET close_reason = 'stop' WHERE stop_time IS NOT NULL AND close_reason IS NULL"))
+
+    create_index(connection, 'ix_quota_close_reason', 'quota', ['close_reason'])
+    create_index(connection, 'ix_quota_stop_time_start_time', 'quota', ['stop_time', 'start_time'])
@@ -0,0 +1,31 @@
+"""
+Make quota.spawner_instance_id unique so that clock events can be deduplicated.
+
+A retried start used to add a second row for the same spawner. Any duplicates are removed first, keeping the oldest row.
+Since the duplicates were also counted when the quota ledger and daily usage rollup were backfilled, both are then rebuilt.
+"""
+
+from sqlalchemy import text
+
+from .utils import create_index, drop_index
+from . import v0008_quota_ledger
+from . import v0009_quota_usage_daily
+
+VERSION = 11
+
+def upgrade(connection) -> None:
+    result = connection.execute(text("""
+        DELETE FROM quota
+        WHERE spawner_instance_id IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM quota WHERE spawner_instance_id IS NOT NULL GROUP BY spawner_instance_id
+        )
+    """))
+
+    if result.rowcount:
+        connection.execute(text("DELETE FROM quota_ledger"))
+        connection.execute(text("DELETE FROM quota_usage_daily"))
+        v0008_quota_ledger.backfill(connection)
+        v0009_quota_usage_daily.backfill(connection)
+
+    drop_index(connection, 'ix_quota_spawner_instance_id')
+    create_index(connection, 'ix_quota_spawner_instance_id', 'quota', ['spawner_instance_id'], unique=True)
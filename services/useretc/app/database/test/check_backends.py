@@ -0,0 +1,235 @@
+"""
+Check the DB code paths that differ between SQLite and Postgres against an empty scratch DB.
+
+Creates the schema through the migrations, runs the bulk upserts (including rows that repeat a key), closes quota sessions in batches,
+corrects a reaped session with its late real stop, writes geolocation batches and pages through them, then runs concurrent calls through the
+connection pool and, on Postgres, checks that pool_pre_ping replaces connections the server dropped. Every table is dropped again at the end.
+
+Run it once per backend, from within the app directory:
+
+    python database/test/check_backends.py
+    python database/test/check_backends.py postgresql+psycopg2://postgres@localhost/useretc_check
+
+Without a url, a temporary SQLite file is used. A Postgres DB must be empty.
+`database/test/check_backends.sh` runs both, starting a throwaway Postgres container if no url is given.
+"""
+
+import os
+import sys
+import asyncio
+import pathlib
+import tempfile
+import datetime
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.pool import NullPool, QueuePool
+
+sys.path.append(str(pathlib.Path(__file__).parents[3]))
+
+if len(sys.argv) > 1:
+    url = sys.argv[1]
+else:
+    url = f"sqlite:///{tempfile.mkdtemp()}/useretc.db"
+
+check_engine = create_engine(url)
+existing_tables = inspect(check_engine).get_table_names()
+check_engine.dispose()
+if existing_tables:
+    sys.exit(f"{url} is not empty: {existing_tables}")
+
+# The app builds its engine and migrates the DB on import
+os.environ['USERETC_DATABASE_URL'] = url
+
+from app.database import migrate, schema
+from app.database.get_db import run_in_db_executor
+from app.database.config import db_config
+from app.database.migrations import LATEST_VERSION
+from app.database.schema import SessionLocal, Quota, QuotaLedger, QuotaUsageDaily, GeoLocation, GeoLocationDailyUser
+from app.database.utils import InvalidCursor, combine_rows_by_key, upsert, upsert_statement
+from app.quota.backend import crud as quota_crud
+from app.geolocation.backend import crud as geolocation_crud
+
+LEDGER_KEYS = {
+    'index_elements': ['username', 'lab_short_name', 'month'],
+    'update_columns': ['last_cpu_hour'],
+    'increment_columns': ['credits_used', 'hours']
+}
+
+def ledger_row(username: str, credits_used: float, last_cpu_hour: float) -> dict:
+    return {
+        'username': username,
+        'lab_short_name': 'lab',
+        'month': datetime.date(2024, 1, 1),
+        'credits_used': credits_used,
+        'hours': credits_used,
+        'last_cpu_hour': last_cpu_hour
+    }
+
+def ledger(db) -> dict:
+    return {
+        record.username: (record.credits_used, record.last_cpu_hour)
+        for record in db.query(QuotaLedger).all()
+    }
+
+def check_schema(db) -> None:
+    with schema.engine.connect() as connection:
+        assert migrate.get_schema_version(connection) == LATEST_VERSION
+
+def check_upsert_repeated_keys(db) -> None:
+    rows = [ledger_row('a', 1.0, 1.0), ledger_row('a', 2.0, 2.0), ledger_row('b', 4.0, 1.0)]
+
+    # Once as inserts and once as conflicts
+    upsert(db, QuotaLedger, rows, **LEDGER_KEYS)
+    upsert(db, QuotaLedger, rows, **LEDGER_KEYS)
+    db.commit()
+    assert ledger(db) == {'a': (6.0, 2.0), 'b': (8.0, 1.0)}, ledger(db)
+
+    db.query(QuotaLedger).delete()
+    db.commit()
+
+def check_upsert_multi_values(db) -> None:
+    # Some drivers send an executemany as one multi-VALUES statement, e.g. psycopg2's execute_values.
+    # Postgres fails such an ON CONFLICT DO UPDATE if two rows share a key, so upsert merges them first.
+    rows = [ledger_row('a', 1.0, 1.0), ledger_row('a', 2.0, 2.0), ledger_row('b', 4.0, 1.0)]
+    stmt = upsert_statement(db, QuotaLedger, **LEDGER_KEYS)
+
+    db.execute(stmt.values(combine_rows_by_key(rows, **LEDGER_KEYS)))
+    db.execute(stmt.values(combine_rows_by_key(rows, **LEDGER_KEYS)))
+    db.commit()
+    assert ledger(db) == {'a': (6.0, 2.0), 'b': (8.0, 1.0)}, ledger(db)
+
+    db.query(QuotaLedger).delete()
+    db.commit()
+
+async def check_close_sessions(db) -> None:
+    # Sessions of one user, lab and profile on the same day share their ledger and daily usage keys
+    start_time = datetime.datetime(2024, 1, 10, 1)
+    events = [
+        {
+            'spawner_instance_id': f"spawner-{i}",
+            'username': 'u',
+            'lab_short_name': 'lab',
+            'start_time': start_time,
+            'profile_name': 'p',
+            'cpu_hour': 2.0
+        } for i in range(4)
+    ]
+    # A retried start is ignored
+    await quota_crud.update_quota_for_start(events + events[:1], db=db)
+    assert db.query(Quota).count() == 4
+
+    # Three stopped in one batch, one of them twice
+    stop_events = [
+        {'spawner_instance_id': f"spawner-{i}", 'stop_time': start_time + datetime.timedelta(hours=1)}
+        for i in [0, 1, 2, 0]
+    ]
+    await quota_crud.update_quota_for_stop(stop_events, db=db)
+
+    # The last one is reaped at its max age
+    reaper_config = db_config['quota_reaper']
+    max_session_hours = reaper_config['max_session_hours']
+    reaper_config['max_session_hours'] = 2
+    try:
+        counts = await quota_crud.reap_stale_sessions(now=start_time + datetime.timedelta(days=1))
+    finally:
+        reaper_config['max_session_hours'] = max_session_hours
+    assert counts['max_age'] == 1, counts
+
+    db.expire_all()
+    assert ledger(db) == {'u': (10.0, 2.0)}, ledger(db)
+    usage = [(record.day, record.hours, record.credits_used) for record in db.query(QuotaUsageDaily).all()]
+    assert usage == [(datetime.date(2024, 1, 10), 5.0, 10.0)], usage
+
+    # Its real stop arrives late and replaces the reaper's stop time
+    await quota_crud.update_quota_for_stop([{'spawner_instance_id': 'spawner-3', 'stop_time': start_time + datetime.timedelta(hours=3)}], db=db)
+
+    db.expire_all()
+    assert ledger(db) == {'u': (12.0, 2.0)}, ledger(db)
+    usage = [(record.day, record.hours, record.credits_used) for record in db.query(QuotaUsageDaily).all()]
+    assert usage == [(datetime.date(2024, 1, 10), 6.0, 12.0)], usage
+
+async def check_geolocation_batch(db) -> None:
+    data_list = [
+        {'username': f"user-{i % 5}", 'ip_address': f"10.0.0.{i}", 'ip_country_status': 'unrestricted', 'country_code': 'US'}
+        for i in range(10)
+    ]
+    await geolocation_crud.add_geodata_batch(data_list, db=db)
+
+    db.expire_all()
+    assert db.query(GeoLocation).count() == 5
+    assert sorted(record.hits for record in db.query(GeoLocationDailyUser).all()) == [2] * 5
+
+async def check_keyset_pagination(db) -> None:
+    usernames = []
+    cursor = None
+    while True:
+        items, cursor = await geolocation_crud.query_geodata(db=db, filters={}, sort='username', descending=True, cursor=cursor, limit=2)
+        usernames += [item['username'] for item in items]
+        if not cursor:
+            break
+    assert usernames == [f"user-{i}" for i in reversed(range(5))], usernames
+
+    try:
+        await geolocation_crud.query_geodata(db=db, filters={}, sort='timestamp', cursor='not-a-cursor')
+    except InvalidCursor:
+        pass
+    else:
+        raise AssertionError("A malformed cursor was accepted")
+
+@run_in_db_executor
+def _backend_id() -> int:
+    db = SessionLocal()
+    try:
+        if schema.engine.dialect.name == 'postgresql':
+            return db.execute(text("SELECT pg_backend_pid()")).scalar()
+        return db.execute(text("SELECT 1")).scalar()
+    finally:
+        db.close()
+
+async def check_pool(db) -> None:
+    assert isinstance(schema.engine.pool, QueuePool), schema.engine.pool
+
+    # More calls than executor workers, so connections are checked out concurrently and reused
+    calls = db_config['executor_max_workers'] * 4
+    checked_out = schema.engine.pool.checkedout()
+    backend_ids = await asyncio.gather(*[_backend_id() for _ in range(calls)])
+    assert len(backend_ids) == calls
+    assert schema.engine.pool.checkedout() == checked_out, schema.engine.pool.status()
+
+    if schema.engine.dialect.name != 'postgresql':
+        return
+
+    assert schema.engine.pool._pre_ping
+    assert 1 < len(set(backend_ids)) <= db_config['pool_size'] + db_config['max_overflow'], set(backend_ids)
+
+    # The server drops every pooled connection, e.g. on a restart or failover. pool_pre_ping replaces them on checkout.
+    db.close()
+    admin_engine = create_engine(url, poolclass=NullPool)
+    try:
+        with admin_engine.connect() as connection:
+            dropped = connection.execute(text(
+                "SELECT count(pg_terminate_backend(pid)) FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()"
+            )).scalar()
+    finally:
+        admin_engine.dispose()
+    assert dropped >= len(set(backend_ids)), dropped
+
+    new_backend_ids = await asyncio.gather(*[_backend_id() for _ in range(calls)])
+    assert not set(new_backend_ids) & set(backend_ids), (backend_ids, new_backend_ids)
+
+async def main():
+    db = SessionLocal()
+    try:
+        for check in [check_schema, check_upsert_repeated_keys, check_upsert_multi_values, check_close_sessions, check_geolocation_batch, check_keyset_pagination, check_pool]:
+            result = check(db)
+            if asyncio.iscoroutine(result):
+                await result
+            print(f"{schema.engine.dialect.name}: {check.__name__} ok")
+    finally:
+        db.close()
+        schema.Base.metadata.drop_all(bind=schema.engine)
+        migrate.metadata.drop_all(bind=schema.engine)
+        schema.engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
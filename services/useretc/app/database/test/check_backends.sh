@@ -0,0 +1,51 @@
+#!/bin/bash
+#
+# Run check_backends.py against SQLite and Postgres, from within the app directory:
+#
+#     bash database/test/check_backends.sh
+#     bash database/test/check_backends.sh postgresql+psycopg2://postgres@localhost/useretc_check
+#
+# Without a url, a throwaway Postgres is started with docker and removed afterwards:
+#
+#     docker run --rm -d --name useretc-check-postgres -p 55432:5432 -e POSTGRES_HOST_AUTH_METHOD=trust -e POSTGRES_DB=useretc_check postgres:16
+#
+# The image and port can be changed with CHECK_POSTGRES_IMAGE and CHECK_POSTGRES_PORT.
+
+set -e
+
+CHECK_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+CHECK_POSTGRES_IMAGE="${CHECK_POSTGRES_IMAGE:-postgres:16}"
+CHECK_POSTGRES_PORT="${CHECK_POSTGRES_PORT:-55432}"
+CONTAINER_NAME=useretc-check-postgres
+
+POSTGRES_URL="$1"
+
+if [ -z "$POSTGRES_URL" ]; then
+    echo "Starting $CHECK_POSTGRES_IMAGE as $CONTAINER_NAME on port $CHECK_POSTGRES_PORT"
+    docker run --rm -d --name $CONTAINER_NAME \
+        -p $CHECK_POSTGRES_PORT:5432 \
+        -e POSTGRES_HOST_AUTH_METHOD=trust \
+        -e POSTGRES_DB=useretc_check \
+        $CHECK_POSTGRES_IMAGE > /dev/null
+    trap "docker stop $CONTAINER_NAME > /dev/null" EXIT
+
+    # The entrypoint restarts the server once the DB is created, so wait for it to answer over TCP
+    for i in $(seq 1 60); do
+        if docker exec $CONTAINER_NAME pg_isready -q -h 127.0.0.1 -U postgres -d useretc_check; then
+            break
+        fi
+        if [ $i == 60 ]; then
+            echo "Postgres did not start"
+            exit 1
+        fi
+        sleep 1
+    done
+
+    POSTGRES_URL="postgresql+psycopg2://postgres@localhost:$CHECK_POSTGRES_PORT/useretc_check"
+fi
+
+echo "Checking SQLite"
+python "$CHECK_DIR/check_backends.py"
+
+echo "Checking Postgres"
+python "$CHECK_DIR/check_backends.py" "$POSTGRES_URL"
@@ -1,3 +1,9 @@
+import json
+import base64
+import datetime
+
+from sqlalchemy import DateTime, and_, or_
+
 def convert_to_dict(record, callback_after=None) -> dict:
     """
     Convert SqlAlchemy Row object to a dictionary
@@ -27,3 +33,168 @@ def convert_to_dict(record, callback_after=None) -> dict:
         obj = callback_after(obj)
 
     return obj
+
+def to_datetime(value) -> datetime.datetime:
+    """
+    Convert a timestamp, as given by the labs or as stored in older string columns, to a naive UTC datetime.
+
+    Returns None for empty values.
+    """
+
+    if not value or str(value) == 'None':
+        return None
+
+    if isinstance(value, datetime.datetime):
+        dt = value
+    elif isinstance(value, datetime.date):
+        dt = datetime.datetime.combine(value, datetime.time())
+    else:
+        dt = datetime.datetime.fromisoformat(str(value).strip())
+
+    if dt.tzinfo:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return dt
+
+def combine_rows_by_key(rows: list, index_elements: list, update_columns: list=None, increment_columns: list=None) -> list:
+    """
+    Merge rows that share the same `index_elements` values into one row, with the result the upsert would have had applying them one by one:
+    `increment_columns` are summed, `update_columns` take the last row's value and any other column keeps the first row's value.
+
+    Postgres refuses an `INSERT ... ON CONFLICT DO UPDATE` that affects the same row twice, which is what repeated keys become when the driver sends an executemany as one multi-VALUES statement.
+    """
+
+    combined = {}
+    for row in rows:
+        key = tuple(row[column] for column in index_elements)
+        if key not in combined:
+            combined[key] = dict(row)
+            continue
+
+        entry = combined[key]
+        for column in update_columns or []:
+            entry[column] = row[column]
+        for column in increment_columns or []:
+            entry[column] = (entry[column] or 0) + (row[column] or 0)
+
+    return list(combined.values())
+
+def upsert_statement(db, model, index_elements: list, update_columns: list=None, increment_columns: list=None):
+    """
+    The `INSERT ... ON CONFLICT` statement used by `upsert`, for the dialect of `db`.
+    """
+
+    dialect_name = db.get_bind().dialect.name
+    if dialect_name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise Exception(f"Upsert is not supported for DB dialect '{dialect_name}'")
+
+    table = model.__table__
+    stmt = insert(table)
+
+    set_ = {column: stmt.excluded[column] for column in update_columns or []}
+    set_.update({column: table.c[column] + stmt.excluded[column] for column in increment_columns or []})
+
+    if set_:
+        return stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_=set_
+        )
+    return stmt.on_conflict_do_nothing(index_elements=index_elements)
+
+def upsert(db, model, rows: list, index_elements: list, update_columns: list=None, increment_columns: list=None) -> None:
+    """
+    Bulk `INSERT ... ON CONFLICT (index_elements) DO UPDATE` of `rows` into the table of `model`. Supported by SQLite and Postgres.
+
+    rows: list of dicts. Every dict must have the same keys since all rows are sent as one executemany.
+        Rows that repeat a key are merged first, see `combine_rows_by_key`.
+    index_elements: columns of a unique index used to detect conflicts.
+    update_columns: columns overwritten on conflict.
+    increment_columns: columns that have the new value added to them on conflict, e.g. counters.
+    If neither is given, conflicting rows are left as is.
+
+    The caller is responsible for committing.
+    """
+
+    if not rows:
+        return
+
+    stmt = upsert_statement(db, model, index_elements, update_columns=update_columns, increment_columns=increment_columns)
+    db.execute(stmt, combine_rows_by_key(rows, index_elements, update_columns=update_columns, increment_columns=increment_columns))
+
+class InvalidCursor(ValueError):
+    """
+    The `cursor` given to `keyset_paginate` was not one it returned, e.g. it was truncated or edited.
+    """
+
+def encode_cursor(sort_value, last_id: int) -> str:
+    if isinstance(sort_value, (datetime.datetime, datetime.date)):
+        sort_value = sort_value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([sort_value, last_id]).encode('utf-8')).decode('utf-8')
+
+def decode_cursor(cursor: str, sort_column) -> tuple:
+    """
+    return: (sort_value, last_id) with the sort value converted to the type of `sort_column`
+
+    Raises InvalidCursor if the cursor cannot be decoded or does not fit `sort_column`.
+    """
+    try:
+        sort_value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+
+        if type(last_id) is not int:
+            raise ValueError(f"last id {last_id!r} is not an integer")
+
+        if sort_value is not None:
+            if isinstance(sort_column.type, DateTime):
+                sort_value = datetime.datetime.fromisoformat(sort_value)
+            elif not isinstance(sort_value, sort_column.type.python_type) or isinstance(sort_value, bool):
+                raise ValueError(f"sort value {sort_value!r} does not fit column '{sort_column.key}'")
+
+    except Exception as e:
+        raise InvalidCursor(f"Invalid cursor... {e}")
+
+    return sort_value, last_id
+
+def keyset_paginate(query, sort_column, id_column, descending: bool=False, cursor: str=None, limit: int=100) -> tuple:
+    """
+    Page through `query` ordered by (sort_column, id_column) using a keyset cursor instead of OFFSET, so every page is an index range scan.
+
+    The query must select both `sort_column` and `id_column`. Rows with a NULL sort value are not returned unless sorting by `id_column`.
+    cursor: opaque string returned as `next_cursor` by the previous page. None for the first page. Raises InvalidCursor if it is not one.
+
+    return: (records, next_cursor). `next_cursor` is None on the last page.
+    """
+
+    is_sort_by_id = sort_column is id_column
+
+    if not is_sort_by_id:
+        query = query.filter(sort_column.isnot(None))
+
+    if cursor:
+        sort_value, last_id = decode_cursor(cursor, sort_column)
+
+        if is_sort_by_id:
+            condition = id_column < last_id if descending else id_column > last_id
+        elif descending:
+            condition = or_(sort_column < sort_value, and_(sort_column == sort_value, id_column < last_id))
+        else:
+            condition = or_(sort_column > sort_value, and_(sort_column == sort_value, id_column > last_id))
+        query = query.filter(condition)
+
+    if descending:
+        query = query.order_by(sort_column.desc(), id_column.desc()) if not is_sort_by_id else query.order_by(id_column.desc())
+    else:
+        query = query.order_by(sort_column, id_column) if not is_sort_by_id else query.order_by(id_column)
+
+    records = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        last_record = records[-1]._mapping
+        next_cursor = encode_cursor(last_record[sort_column.key], last_record[id_column.key])
+
+    return records, next_cursor
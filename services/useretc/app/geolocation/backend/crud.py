@@ -1,10 +1,14 @@
 import datetime
 
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
 from app.utils.logging import log
-from app.database.utils import convert_to_dict
-from app.database.schema import GeoLocation
+from app.utils import background
+from app.database.utils import convert_to_dict, keyset_paginate, to_datetime, upsert
+from app.database.get_db import run_in_db_executor
+from app.database.config import db_config
+from app.database.schema import GeoLocation, GeoLocationHistory, GeoLocationDailyUser, GeoLocationDailyCountry, SessionLocal
 
 """
 username = Column(String, default=None)
@@ -13,44 +17,89 @@ ip_country_status = Column(String, default=None)
 country_code = Column(String, default=None)
 """
 
-async def add_geodata(data, db: Session) -> None:
+def _add_geodata_batch(data_list: list, db: Session) -> list:
     """
-    Keep one row per user. 
+    Keep one up-to-date row per user in `geolocation` so that lookups of the latest location stay cheap.
+    The row is written with a single `INSERT ... ON CONFLICT (username) DO UPDATE`.
 
-    Originally, the idea was to insert a new row per call. But we could easily get 10,000 rows in a couple months. 
-    Since this would become burdensome, only keep one up-to-date entry.
-    IP info will have to be parsed from the logs. Future DB work might allow for the original idea.
+    Every update is also appended to `geolocation_history` and counted in the per-user daily rollup.
+    History is only kept for the retention window (see `prune_geolocation_history`). Rollups are kept much longer.
+
+    All of `data_list` is written in one transaction with one statement per table.
+
+    Returns the usernames whose latest country code changed.
     """
-    
-    row_exists = db.query(GeoLocation).filter(
-            GeoLocation.username == data['username']
-        ).first() is not None
-
-    if row_exists:
-        db.query(GeoLocation).filter(
-                GeoLocation.username == data['username']
-            ).update(
-                {
-                    'ip_address': data['ip_address'], 
-                    'ip_country_status': data['ip_country_status'],
-                    'country_code': data['country_code'],
-                    'timestamp': datetime.datetime.now(datetime.timezone.utc)
-                }
-            )
-        db.commit()
+    data_list = [data for data in data_list if data.get('username')]
+    if not data_list:
+        return []
 
-    else:
-        db_entry = GeoLocation(
-            username=data['username'],
-            ip_address=data['ip_address'], 
-            ip_country_status=data['ip_country_status'],
-            country_code=data['country_code'],
-            timestamp=datetime.datetime.now(datetime.timezone.utc)
-        )
-        db.add(db_entry)
-        db.commit()
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+    history_rows = [
+        {
+            'username': data['username'],
+            'ip_address': data.get('ip_address'),
+            'ip_country_status': data.get('ip_country_status'),
+            'country_code': data.get('country_code'),
+            'timestamp': now
+        } for data in data_list
+    ]
+
+    # The last update of a user within the batch wins
+    latest_rows = list({row['username']: row for row in history_rows}.values())
+
+    daily_hits = {}
+    for row in history_rows:
+        key = (row['username'], row['country_code'] or '')
+        daily_hits[key] = daily_hits.get(key, 0) + 1
+
+    previous_country_codes = dict(
+        db.query(
+            GeoLocation.username,
+            GeoLocation.country_code
+        ).filter(
+            GeoLocation.username.in_([row['username'] for row in latest_rows])
+        ).all()
+    )
+    changed_usernames = [
+        row['username'] for row in latest_rows
+        if row['username'] not in previous_country_codes or previous_country_codes[row['username']] != row['country_code']
+    ]
+
+    upsert(
+        db,
+        GeoLocation,
+        latest_rows,
+        index_elements=['username'],
+        update_columns=['ip_address', 'ip_country_status', 'country_code', 'timestamp']
+    )
+
+    db.execute(GeoLocationHistory.__table__.insert(), history_rows)
+
+    upsert(
+        db,
+        GeoLocationDailyUser,
+        [
+            {'day': now.date(), 'username': username, 'country_code': country_code, 'hits': hits}
+            for (username, country_code), hits in daily_hits.items()
+        ],
+        index_elements=['day', 'username', 'country_code'],
+        increment_columns=['hits']
+    )
+
+    db.commit()
+
+    return changed_usernames
 
-async def get_latest_geodata_for_username(username: str, db: Session) -> dict:
+@run_in_db_executor
+def add_geodata(data: dict, db: Session) -> list:
+    return _add_geodata_batch([data], db)
+
+@run_in_db_executor
+def add_geodata_batch(data_list: list, db: Session) -> list:
+    return _add_geodata_batch(data_list, db)
+
+def _get_latest_geodata_for_username(username: str, db: Session) -> dict:
     record = db.query(
             GeoLocation.username,
             GeoLocation.ip_address,
@@ -80,7 +129,12 @@ async def get_latest_geodata_for_username(username: str, db: Session) -> dict:
 
     return convert_to_dict(record, callback_after=callback)
 
-async def get_all_geodata_for_all(db: Session) -> list:
+@run_in_db_executor
+def get_latest_geodata_for_username(username: str, db: Session) -> dict:
+    return _get_latest_geodata_for_username(username, db)
+
+@run_in_db_executor
+def get_all_geodata_for_all(db: Session) -> list:
     records = db.query(
             GeoLocation.username,
             GeoLocation.ip_address,
@@ -107,3 +161,199 @@ async def get_all_geodata_for_all(db: Session) -> list:
         return obj
 
     return [convert_to_dict(record, callback_after=callback) for record in records]
+
+def iter_all_geodata_for_all(chunk_size: int=1000):
+    """
+    Generator over all geolocation rows using a server-side cursor. It owns its DB session since it outlives the request handler.
+    """
+    db = SessionLocal()
+    try:
+        records = db.query(
+                GeoLocation.username,
+                GeoLocation.ip_address,
+                GeoLocation.ip_country_status,
+                GeoLocation.country_code,
+                GeoLocation.timestamp
+            ).order_by(
+                GeoLocation.timestamp
+            ).yield_per(chunk_size)
+
+        def callback(obj):
+            if obj.get('timestamp', None):
+                obj['timestamp'] = obj['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
+            return obj
+
+        for record in records:
+            yield convert_to_dict(record, callback_after=callback)
+    finally:
+        db.close()
+
+GEODATA_FILTER_FIELDS = ['username', 'country_code', 'ip_country_status']
+
+GEODATA_SORT_FIELDS = ['timestamp', 'username', 'id']
+
+@run_in_db_executor
+def query_geodata(db: Session, filters: dict, timestamp_from: datetime.datetime=None, timestamp_to: datetime.datetime=None, sort: str='timestamp', descending: bool=False, cursor: str=None, limit: int=100) -> tuple:
+    """
+    One page of geolocation rows matching all `filters` ({field: [allowed values]}) and within [timestamp_from, timestamp_to), ordered by `sort`.
+
+    return: (list of rows, next_cursor)
+    """
+    query = db.query(
+            GeoLocation.id,
+            GeoLocation.username,
+            GeoLocation.ip_address,
+            GeoLocation.ip_country_status,
+            GeoLocation.country_code,
+            GeoLocation.timestamp
+        )
+
+    for field, values in filters.items():
+        query = query.filter(getattr(GeoLocation, field).in_(values))
+
+    if timestamp_from:
+        query = query.filter(GeoLocation.timestamp >= to_datetime(timestamp_from))
+    if timestamp_to:
+        query = query.filter(GeoLocation.timestamp < to_datetime(timestamp_to))
+
+    records, next_cursor = keyset_paginate(
+        query,
+        sort_column=getattr(GeoLocation, sort),
+        id_column=GeoLocation.id,
+        descending=descending,
+        cursor=cursor,
+        limit=limit
+    )
+
+    def callback(obj):
+        if obj.get('timestamp', None):
+            obj['timestamp'] = obj['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
+        return obj
+
+    return [convert_to_dict(record, callback_after=callback) for record in records], next_cursor
+
+@run_in_db_executor
+def get_geodata_history_for_username(username: str, db: Session, limit: int=100) -> list:
+    """
+    Most recent geolocation updates of `username` within the retention window, newest first.
+    """
+    records = db.query(
+            GeoLocationHistory.username,
+            GeoLocationHistory.ip_address,
+            GeoLocationHistory.ip_country_status,
+            GeoLocationHistory.country_code,
+            GeoLocationHistory.timestamp
+        ).filter(
+            GeoLocationHistory.username == username
+        ).order_by(
+            GeoLocationHistory.timestamp.desc()
+        ).limit(limit).all()
+
+    def callback(obj):
+        if obj.get('timestamp', None):
+            obj['timestamp'] = obj['timestamp'].strftime("%Y-%m-%d %H:%M:%S")
+        return obj
+
+    return [convert_to_dict(record, callback_after=callback) for record in records]
+
+@run_in_db_executor
+def get_daily_geodata_by_country(db: Session, day_from: datetime.date=None, day_to: datetime.date=None, country_codes: list=None) -> list:
+    """
+    Daily number of distinct users and updates per country within [day_from, day_to].
+    """
+    query = db.query(
+            GeoLocationDailyCountry.day,
+            GeoLocationDailyCountry.country_code,
+            GeoLocationDailyCountry.users,
+            GeoLocationDailyCountry.hits
+        )
+
+    if day_from:
+        query = query.filter(GeoLocationDailyCountry.day >= day_from)
+    if day_to:
+        query = query.filter(GeoLocationDailyCountry.day <= day_to)
+    if country_codes:
+        query = query.filter(GeoLocationDailyCountry.country_code.in_(country_codes))
+
+    records = query.order_by(GeoLocationDailyCountry.day, GeoLocationDailyCountry.country_code).all()
+
+    def callback(obj):
+        obj['day'] = obj['day'].isoformat()
+        return obj
+
+    return [convert_to_dict(record, callback_after=callback) for record in records]
+
+# Number of recent days the per-country rollup is rebuilt for on every run. Covers updates that land right around midnight.
+ROLLUP_REFRESH_DAYS = 2
+
+# Max rows deleted per statement so pruning never holds a long write lock
+PRUNE_BATCH_SIZE = 5000
+
+def _delete_in_batches(db: Session, model, column, cutoff) -> int:
+    deleted = 0
+    while True:
+        ids = [
+            row.id for row in db.query(model.id).filter(column < cutoff).limit(PRUNE_BATCH_SIZE).all()
+        ]
+        if not ids:
+            return deleted
+        db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        deleted += len(ids)
+
+def _refresh_daily_country_rollup(db: Session, day_from: datetime.date) -> None:
+    records = db.query(
+            GeoLocationDailyUser.day,
+            GeoLocationDailyUser.country_code,
+            func.count(GeoLocationDailyUser.username).label('users'),
+            func.sum(GeoLocationDailyUser.hits).label('hits')
+        ).filter(
+            GeoLocationDailyUser.day >= day_from
+        ).group_by(
+            GeoLocationDailyUser.day,
+            GeoLocationDailyUser.country_code
+        ).all()
+
+    rows = [
+        {'day': record.day, 'country_code': record.country_code, 'users': record.users, 'hits': int(record.hits or 0)}
+        for record in records
+    ]
+    upsert(
+        db,
+        GeoLocationDailyCountry,
+        rows,
+        index_elements=['day', 'country_code'],
+        update_columns=['users', 'hits']
+    )
+    db.commit()
+
+@run_in_db_executor
+def prune_geolocation_history() -> dict:
+    """
+    Refresh the recent per-country rollups and delete history and rollups older than their retention windows.
+    """
+    retention = db_config['retention']
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+    history_cutoff = now - datetime.timedelta(days=retention['geolocation_history_days'])
+    rollup_cutoff = (now - datetime.timedelta(days=retention['geolocation_rollup_days'])).date()
+
+    db = SessionLocal()
+    try:
+        _refresh_daily_country_rollup(db, now.date() - datetime.timedelta(days=ROLLUP_REFRESH_DAYS - 1))
+
+        counts = {
+            'history': _delete_in_batches(db, GeoLocationHistory, GeoLocationHistory.timestamp, history_cutoff),
+            'daily_user': _delete_in_batches(db, GeoLocationDailyUser, GeoLocationDailyUser.day, rollup_cutoff),
+            'daily_country': _delete_in_batches(db, GeoLocationDailyCountry, GeoLocationDailyCountry.day, rollup_cutoff),
+        }
+    finally:
+        db.close()
+
+    if any(counts.values()):
+        log.info(f"Pruned geolocation rows: {counts}")
+    return counts
+
+@background.periodic(db_config['retention']['prune_interval_seconds'], name='prune_geolocation_history')
+async def _prune_geolocation_history_job():
+    await prune_geolocation_history()
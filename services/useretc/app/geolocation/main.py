@@ -1,54 +1,95 @@
 
 import pathlib
 from urllib.parse import unquote
-import io
-import datetime
+from datetime import datetime, date
 
 CWD = pathlib.Path(__file__).parent.absolute().resolve()
 
-import pandas as pd
-from fastapi import APIRouter, Request, Depends
-from fastapi.responses import JSONResponse, StreamingResponse
-from fastapi.encoders import jsonable_encoder
+from fastapi import APIRouter, Request, Depends, BackgroundTasks, HTTPException, status
 from sqlalchemy.orm import Session
 
 from .backend import crud
+from app.utils import helps
 from app.utils.decorator import user_type
 from app.utils.logging import log
+from app.utils.stream import streaming_response
 from app.database.get_db import get_db
+from app.database.utils import InvalidCursor
 from opensarlab.auth import encryptedjwt
 
 router = APIRouter(
     prefix="/geolocation",
 )
 
+QUERY_MAX_LIMIT = 1000
+
 @router.get('/all')
 @user_type('admin')
-async def get_all_geo_data(request: Request, format: str = 'text', db: Session = Depends(get_db)):
-    """
-    Serve raw data of all geolocation data
+async def get_all_geo_data(request: Request, format: str = 'text'):
     """
-    data = await crud.get_all_geodata_for_all(db=db)
-    json_data = jsonable_encoder(data)
+    Stream raw data of all geolocation data
 
-    if format == 'encrypted':
-        return encryptedjwt.encrypt(json_data)
+    format: 'text' (JSON list), 'csv', 'ndjson' or 'encrypted' (one encrypted list of rows per line)
+    """
+    return streaming_response(
+        crud.iter_all_geodata_for_all(),
+        format=format,
+        fieldnames=['username', 'ip_address', 'ip_country_status', 'country_code', 'timestamp'],
+        filename_prefix="geolocation"
+    )
 
-    elif format == 'csv':
-        df = pd.DataFrame(json_data)
-        stream = io.StringIO()
+@router.get('/query')
+@user_type('admin')
+async def get_query_geo_data(request: Request, timestamp_from: datetime = None, timestamp_to: datetime = None, sort: str = 'timestamp', cursor: str = None, limit: int = 100, db_session: Session = Depends(get_db)) -> dict:
+    """
+    Page through geolocation data, e.g. `/geolocation/query?country_code=US&country_code=CA&timestamp_from=2024-01-01&sort=-timestamp`
 
-        df.to_csv(stream, index = False)
+    Any of `crud.GEODATA_FILTER_FIELDS` can be given, more than once to match any of the values.
+    Pass the returned `next_cursor` as `cursor` to get the next page. It is null on the last page.
+    """
+    filters = helps.get_filters_from_query_params(request, crud.GEODATA_FILTER_FIELDS, reserved_params=['timestamp_from', 'timestamp_to', 'sort', 'cursor', 'limit'])
+    sort_field, descending = helps.get_sort_from_query_param(sort, crud.GEODATA_SORT_FIELDS)
+    limit = max(1, min(limit, QUERY_MAX_LIMIT))
 
-        response = StreamingResponse(
-            iter([stream.getvalue()]),
-            media_type="text/csv"
+    try:
+        items, next_cursor = await crud.query_geodata(
+            db=db_session,
+            filters=filters,
+            timestamp_from=timestamp_from,
+            timestamp_to=timestamp_to,
+            sort=sort_field,
+            descending=descending,
+            cursor=cursor,
+            limit=limit
         )
-        response.headers["Content-Disposition"] = f"attachment; filename=profiles_{datetime.datetime.now()}.csv"
-        return response
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
-    else:
-        return JSONResponse(json_data)
+    return {
+        'items': items,
+        'next_cursor': next_cursor
+    }
+
+@router.get('/history/username/{username}')
+@user_type('admin')
+async def get_user_geo_history(request: Request, username: str, limit: int = 100, db_session: Session = Depends(get_db)) -> list:
+    """
+    Most recent geolocation updates of the user, newest first. Only updates within the history retention window are kept.
+    """
+    username = unquote(username)
+    limit = max(1, min(limit, QUERY_MAX_LIMIT))
+    return await crud.get_geodata_history_for_username(username, db=db_session, limit=limit)
+
+@router.get('/daily/country')
+@user_type('admin')
+async def get_daily_country_geo_data(request: Request, day_from: date = None, day_to: date = None, db_session: Session = Depends(get_db)) -> list:
+    """
+    Daily distinct users and updates per country, e.g. `/geolocation/daily/country?day_from=2024-01-01&country_code=US`
+
+    Today's numbers are refreshed by a background job and so may lag slightly.
+    """
+    country_codes = request.query_params.getlist('country_code')
+    return await crud.get_daily_geodata_by_country(db=db_session, day_from=day_from, day_to=day_to, country_codes=country_codes)
 
 @router.get('/latest/username/{username}')
 async def get_user_geo_data(request: Request, username: str, db_session: Session = Depends(get_db)):
@@ -57,7 +98,21 @@ async def get_user_geo_data(request: Request, username: str, db_session: Session
     return encryptedjwt.encrypt(data)
 
 @router.post('/update')
-async def post_user_geo_data(request: Request, db_session: Session = Depends(get_db)):
+async def post_user_geo_data(request: Request, background_tasks: BackgroundTasks, db_session: Session = Depends(get_db)):
     request_data = await request.body()
     data = encryptedjwt.decrypt(request_data)
-    await crud.add_geodata(data, db=db_session)
+    changed_usernames = await crud.add_geodata(data, db=db_session)
+    if changed_usernames:
+        background_tasks.add_task(helps.invalidate_portal_auth_cache, changed_usernames)
+
+@router.post('/update/batch')
+async def post_user_geo_data_batch(request: Request, background_tasks: BackgroundTasks, db_session: Session = Depends(get_db)) -> dict:
+    """
+    Body is a JSON list of encrypted updates, each the same as the body of `/geolocation/update`. All are written in one transaction.
+    """
+    request_data = await request.json()
+    data_list = [encryptedjwt.decrypt(item) for item in request_data]
+    changed_usernames = await crud.add_geodata_batch(data_list, db=db_session)
+    if changed_usernames:
+        background_tasks.add_task(helps.invalidate_portal_auth_cache, changed_usernames)
+    return {'count': len(data_list)}
@@ -8,8 +8,10 @@ from email_service.main import router as email_router
 from helps.main import router as helps_router
 from geolocation.main import router as geolocation_router
 from request.main import router as request_router
+from bundle.main import router as bundle_router
+from app.utils import background
 
-app = FastAPI(root_path="/user")
+app = FastAPI(root_path="/user", lifespan=background.lifespan)
 
 app.include_router(profile_router)
 app.include_router(notifications_router)
@@ -19,3 +21,4 @@ app.include_router(email_router)
 app.include_router(helps_router)
 app.include_router(geolocation_router)
 app.include_router(request_router)
+app.include_router(bundle_router)
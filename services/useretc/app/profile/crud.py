@@ -1,26 +1,94 @@
+from sqlalchemy import Boolean
 from sqlalchemy.orm import Session
 
-from app.database.schema import Profile
-from app.database.utils import convert_to_dict
+from app.database.schema import Profile, SessionLocal
+from app.database.utils import convert_to_dict, keyset_paginate
+from app.database.get_db import run_in_db_executor
 
+@run_in_db_executor
 def check_user_profile_username(db: Session, username: str) -> bool:
     profile = db.query(Profile).filter(Profile.username == username).first()
     if not profile:
         return False
     return not profile.force_update
 
+@run_in_db_executor
 def get_all_profiles(db: Session) -> list:
     records = db.query(Profile).all()
     if not records:
         return []
     return [convert_to_dict(record) for record in records]
 
-def get_profile_by_username(db: Session, username: str) -> dict:
+PROFILE_FILTER_FIELDS = [
+    'username',
+    'country_of_residence',
+    'is_affliated_with_nasa_research',
+    'has_affliated_with_nasa_research_email',
+    'is_affliated_with_gov_research',
+    'is_affliated_with_isro_research',
+    'is_affliated_with_university',
+    'faculty_member_affliated_with_university',
+    'research_member_affliated_with_university',
+    'graduate_student_affliated_with_university',
+    'force_update',
+]
+
+PROFILE_SORT_FIELDS = ['id', 'username']
+
+@run_in_db_executor
+def query_profiles(db: Session, filters: dict, sort: str='id', descending: bool=False, cursor: str=None, limit: int=100) -> tuple:
+    """
+    One page of profiles matching all `filters` ({field: [allowed values]}), ordered by `sort`.
+
+    return: (list of profiles, next_cursor)
+    """
+    query = db.query(*Profile.__table__.columns)
+
+    for field, values in filters.items():
+        column = getattr(Profile, field)
+        if isinstance(column.type, Boolean):
+            values = [str(value).lower() in ('true', '1', 'yes') for value in values]
+        query = query.filter(column.in_(values))
+
+    records, next_cursor = keyset_paginate(
+        query,
+        sort_column=getattr(Profile, sort),
+        id_column=Profile.id,
+        descending=descending,
+        cursor=cursor,
+        limit=limit
+    )
+
+    return [convert_to_dict(record) for record in records], next_cursor
+
+def iter_all_profiles(chunk_size: int=1000):
+    """
+    Generator over all profiles using a server-side cursor. It owns its DB session since it outlives the request handler.
+    """
+    db = SessionLocal()
+    try:
+        records = db.query(
+                *Profile.__table__.columns
+            ).order_by(
+                Profile.id
+            ).yield_per(chunk_size)
+
+        for record in records:
+            yield convert_to_dict(record)
+    finally:
+        db.close()
+
+def _get_profile_by_username(db: Session, username: str) -> dict:
     record = db.query(Profile).filter(Profile.username == username).first()
     if not record:
         return {}
     return convert_to_dict(record)
 
+@run_in_db_executor
+def get_profile_by_username(db: Session, username: str) -> dict:
+    return _get_profile_by_username(db, username)
+
+@run_in_db_executor
 def create_profile(db: Session, username: str, profile: dict) -> dict:
     record = Profile(username=username, **profile)
     db.add(record)
@@ -31,6 +99,7 @@ def create_profile(db: Session, username: str, profile: dict) -> dict:
         return {}
     return convert_to_dict(record)
 
+@run_in_db_executor
 def update_profile_by_username(db: Session, username: str, profile: dict) -> int:
     # Since we are now updating the row, any "force_update" is satisfied.
     profile.update( {'force_update': False } )
@@ -2,23 +2,25 @@
 import datetime
 import pathlib
 import json
-import io
 from urllib.parse import unquote
 
 CWD = pathlib.Path(__file__).parent.resolve().absolute()
 
-import pandas as pd
-from fastapi import Depends, Request, status, APIRouter
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse
+from fastapi import Depends, Request, status, APIRouter, HTTPException
+from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.encoders import jsonable_encoder
 from sqlalchemy.orm import Session
 
 from opensarlab.auth import encryptedjwt
 
+from app.utils import helps
 from app.utils.logging import log
 from app.utils.decorator import user_type
+from app.utils.stream import streaming_response
 from app.database.get_db import get_db
+from app.database.schema import Profile
+from app.database.utils import InvalidCursor
 from . import crud
 from . import validate
 
@@ -28,33 +30,45 @@ router = APIRouter(
 
 templates = Jinja2Templates(directory=f"{CWD}/web")
 
+QUERY_MAX_LIMIT = 1000
+
 @router.get('/all')
 @user_type('admin')
-async def get_all_user_profiles(request: Request, format: str = 'text', db: Session = Depends(get_db)):
-    """
-    Serve raw data of all profiles
+async def get_all_user_profiles(request: Request, format: str = 'text'):
     """
-    data = crud.get_all_profiles(db=db)
-    json_data = jsonable_encoder(data)
-
-    if format == 'encrypted':
-        return encryptedjwt.encrypt(json_data)
+    Stream raw data of all profiles
 
-    elif format == 'csv':
-        df = pd.DataFrame(json_data)
-        stream = io.StringIO()
+    format: 'text' (JSON list), 'csv', 'ndjson' or 'encrypted' (one encrypted list of profiles per line)
+    """
+    return streaming_response(
+        crud.iter_all_profiles(),
+        format=format,
+        fieldnames=[column.name for column in Profile.__table__.columns],
+        filename_prefix="profiles"
+    )
+
+@router.get('/query')
+@user_type('admin')
+async def get_query_user_profiles(request: Request, sort: str = 'id', cursor: str = None, limit: int = 100, db: Session = Depends(get_db)) -> dict:
+    """
+    Page through profiles, e.g. `/profile/query?country_of_residence=Canada&is_affliated_with_university=Yes&sort=-id&limit=500`
 
-        df.to_csv(stream, index = False)
+    Any of `crud.PROFILE_FILTER_FIELDS` can be given, more than once to match any of the values.
+    Pass the returned `next_cursor` as `cursor` to get the next page. It is null on the last page.
+    """
+    filters = helps.get_filters_from_query_params(request, crud.PROFILE_FILTER_FIELDS, reserved_params=['sort', 'cursor', 'limit'])
+    sort_field, descending = helps.get_sort_from_query_param(sort, crud.PROFILE_SORT_FIELDS)
+    limit = max(1, min(limit, QUERY_MAX_LIMIT))
 
-        response = StreamingResponse(
-            iter([stream.getvalue()]),
-            media_type="text/csv"
-        )
-        response.headers["Content-Disposition"] = f"attachment; filename=profiles_{datetime.datetime.now()}.csv"
-        return response
+    try:
+        items, next_cursor = await crud.query_profiles(db=db, filters=filters, sort=sort_field, descending=descending, cursor=cursor, limit=limit)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
-    else:
-        return JSONResponse(json_data)
+    return {
+        'items': jsonable_encoder(items),
+        'next_cursor': next_cursor
+    }
 
 @router.get('/check/{username}')
 @user_type('admin', 'user')
@@ -63,7 +77,7 @@ async def get_check_user_profile(request: Request, username: str, db: Session =
     DB check if user has already submitted form
     """
     username = unquote(username)
-    status = crud.check_user_profile_username(db=db, username=username)
+    status = await crud.check_user_profile_username(db=db, username=username)
     return encryptedjwt.encrypt(jsonable_encoder(status))
 
 @router.get('/raw/{username}')
@@ -72,15 +86,15 @@ async def get_raw_user_profile(request: Request, username: str, db: Session = De
     Serve raw data of user's profile
     """
     username = unquote(username)
-    data = crud.get_profile_by_username(db=db, username=username)
+    data = await crud.get_profile_by_username(db=db, username=username)
     if not data:
         data = {}
     return encryptedjwt.encrypt(data)
 
-def _render_template(request: Request, username: str, previous: str, db: Session, err_string: str=None) -> str:
+async def _render_template(request: Request, username: str, previous: str, db: Session, err_string: str=None) -> str:
 
     try:
-        user_profile = crud.get_profile_by_username(db=db, username=username)
+        user_profile = await crud.get_profile_by_username(db=db, username=username)
     except Exception as e:
         log.error(f"Something went wrong with getting the profile from the database for {username}: {e}")
         err_string = "Something went wrong with getting your user profile info. Please contact an OpenScienceLab admin."
@@ -175,10 +189,13 @@ async def post_show_user_profile(request: Request, username: str, previous: str=
     try:
         validate.validate_form(form)
 
-        num_rows = crud.update_profile_by_username(db=db, username=username, profile=form)
+        num_rows = await crud.update_profile_by_username(db=db, username=username, profile=form)
         if num_rows == 0:
             log.warning(f"No rows updated for {username} means no user exists. Thus create one...")
-            crud.create_profile(db=db, username=username, profile=form)
+            await crud.create_profile(db=db, username=username, profile=form)
+
+        # The profile's force_update feeds the portal's auth data. Drop it before redirecting so the next page sees the new profile.
+        await helps.invalidate_portal_auth_cache([username])
 
         return RedirectResponse(previous, status_code=status.HTTP_302_FOUND)
     
@@ -189,7 +206,7 @@ async def post_show_user_profile(request: Request, username: str, previous: str=
         log.error(f"Unknown error: {e}")
         err_string = f"An unknown error occurred. If this persists, contact an OpenScienceLab admin."
 
-    return _render_template(request, username, previous, db, err_string=err_string)
+    return await _render_template(request, username, previous, db, err_string=err_string)
 
 @router.get('/show/{username}', response_class=HTMLResponse)
 @user_type('user')
@@ -199,4 +216,4 @@ async def get_show_user_profile(request: Request, username: str, previous: str='
     """
     username = unquote(username)
     previous = unquote(previous)
-    return _render_template(request, username, previous, db)
+    return await _render_template(request, username, previous, db)
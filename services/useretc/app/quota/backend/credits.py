@@ -0,0 +1,67 @@
+from datetime import date, datetime, timedelta, timezone
+
+import pandas as pd
+
+def calculate_credits_used(quotas: list, now: datetime=None) -> dict:
+    """
+    Credits used by the sessions in `quotas` (as returned by `crud.get_quotas_used_within_time_period`). One credit is one hour at `cpu_hour` of 1.
+
+    The DataFrame is built in one pass from all records and every step is vectorized, so the time taken is linear in the number of sessions.
+    If stop_time is not defined, then there is probably an active server. It is replaced by `now` (naive UTC, like the session times) to help calculate real time.
+
+    return: {'total_credits_used': float, 'cpu_hour': cpu_hour of the last session} or None if there are no sessions
+    """
+    if not quotas:
+        return None
+
+    if now is None:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    data_frame = pd.DataFrame.from_records(quotas, columns=['profile_name', 'cpu_hour', 'start_time', 'stop_time'])
+
+    start_time = pd.to_datetime(data_frame['start_time'])
+    stop_time = pd.to_datetime(data_frame['stop_time']).fillna(pd.Timestamp(now))
+    cpu_hour = pd.to_numeric(data_frame['cpu_hour'], errors='coerce')
+
+    total_hours = (stop_time - start_time).dt.total_seconds() / 3600.0
+    credits_used = total_hours * cpu_hour
+
+    return {
+        'total_credits_used': float(credits_used.sum()),
+        'cpu_hour': float(cpu_hour.iloc[-1])
+    }
+
+def month_of(value: datetime) -> date:
+    return date(value.year, value.month, 1)
+
+def next_month(month: date) -> date:
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def _split_hours(start_time: datetime, stop_time: datetime, period_of, next_period) -> list:
+    if not start_time or not stop_time:
+        return []
+
+    parts = []
+    part_start = start_time
+    while part_start < stop_time:
+        period = period_of(part_start)
+        part_stop = min(stop_time, datetime.combine(next_period(period), datetime.min.time()))
+        parts.append((period, (part_stop - part_start).total_seconds() / 3600.0))
+        part_start = part_stop
+    return parts
+
+def split_hours_by_month(start_time: datetime, stop_time: datetime) -> list:
+    """
+    Split the session [start_time, stop_time) at month boundaries.
+
+    return: list of (first day of month, hours within that month)
+    """
+    return _split_hours(start_time, stop_time, month_of, next_month)
+
+def split_hours_by_day(start_time: datetime, stop_time: datetime) -> list:
+    """
+    Split the session [start_time, stop_time) at midnight.
+
+    return: list of (day, hours within that day)
+    """
+    return _split_hours(start_time, stop_time, lambda value: value.date(), lambda day: day + timedelta(days=1))
@@ -1,39 +1,264 @@
 
-from datetime import datetime
+from datetime import date, datetime, time, timedelta, timezone
 
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, tuple_, func, update, bindparam
 from sqlalchemy.orm import Session
 
 from app.utils.logging import log
-from app.database.utils import convert_to_dict
-from app.database.schema import Quota
-
-async def update_quota_for_start(data, db: Session) -> None:
-
-    db_entry = Quota(
-        spawner_instance_id=data['spawner_instance_id'],
-        username=data['username'],
-        lab_short_name=data['lab_short_name'], 
-        start_time=data['start_time'],
-        profile_name=data['profile_name'],
-        cpu_hour=data['cpu_hour'],
+from app.utils import background
+from app.database.utils import convert_to_dict, to_datetime, upsert
+from app.database.get_db import run_in_db_executor
+from app.database.config import db_config
+from app.database.schema import Quota, QuotaLedger, QuotaUsageDaily, SessionLocal
+from .credits import split_hours_by_month, split_hours_by_day
+
+@run_in_db_executor
+def update_quota_for_start(events: list, db: Session) -> None:
+    """
+    Add a session per start event. A session that already exists for the spawner_instance_id is left as is, so retried starts are harmless.
+    """
+    rows = [
+        {
+            'spawner_instance_id': data['spawner_instance_id'],
+            'username': data['username'],
+            'lab_short_name': data['lab_short_name'],
+            'start_time': to_datetime(data['start_time']),
+            'profile_name': data['profile_name'],
+            'cpu_hour': float(data['cpu_hour']),
+        } for data in events
+    ]
+
+    upsert(db, Quota, rows, index_elements=['spawner_instance_id'])
+    db.commit()
+
+def ledger_rows_for_session(username: str, lab_short_name: str, cpu_hour: float, start_time: datetime, stop_time: datetime) -> list:
+    """
+    Rows to add to the quota ledger for a closed session. A session that crosses a month boundary is split between the months.
+    """
+    cpu_hour = cpu_hour or 0.0
+    return [
+        {
+            'username': username,
+            'lab_short_name': lab_short_name,
+            'month': month,
+            'credits_used': hours * cpu_hour,
+            'hours': hours,
+            'last_cpu_hour': cpu_hour
+        } for month, hours in split_hours_by_month(start_time, stop_time)
+    ]
+
+def add_to_ledger(db: Session, ledger_rows: list) -> None:
+    """
+    Add credits and hours to the ledger. The caller is responsible for committing.
+    """
+    upsert(
+        db,
+        QuotaLedger,
+        ledger_rows,
+        index_elements=['username', 'lab_short_name', 'month'],
+        update_columns=['last_cpu_hour'],
+        increment_columns=['credits_used', 'hours']
+    )
+
+def daily_usage_rows_for_session(username: str, lab_short_name: str, profile_name: str, cpu_hour: float, start_time: datetime, stop_time: datetime) -> list:
+    """
+    Rows to add to the daily usage rollup for a closed session, split at midnight.
+    """
+    cpu_hour = cpu_hour or 0.0
+    return [
+        {
+            'day': day,
+            'lab_short_name': lab_short_name or '',
+            'profile_name': profile_name or '',
+            'username': username or '',
+            'hours': hours,
+            'credits_used': hours * cpu_hour
+        } for day, hours in split_hours_by_day(start_time, stop_time)
+    ]
+
+def add_to_daily_usage(db: Session, usage_rows: list) -> None:
+    """
+    Add hours and credits to the daily usage rollup. The caller is responsible for committing.
+    """
+    upsert(
+        db,
+        QuotaUsageDaily,
+        usage_rows,
+        index_elements=['day', 'lab_short_name', 'profile_name', 'username'],
+        increment_columns=['hours', 'credits_used']
     )
-    db.add(db_entry)
+
+def _close_sessions(db: Session, quotas: list, close_reason: str, stop_time_of) -> int:
+    """
+    Set the stop time of open sessions and add them to the quota ledger and daily usage rollup. The caller is responsible for committing.
+
+    quotas: rows with id, username, lab_short_name, profile_name, cpu_hour, start_time and heartbeat_time
+    stop_time_of: callable giving the stop time of a row
+
+    Sessions that are already stopped are left as is so that a repeated stop is not counted twice.
+
+    return: number of sessions closed
+    """
+    closed_count = 0
+    ledger_rows = []
+    usage_rows = []
+    for quota in quotas:
+        stop_time = stop_time_of(quota)
+
+        # Only the request that actually closes the session adds it to the ledger
+        updated_count = db.query(Quota).filter(
+                Quota.id == quota.id,
+                Quota.stop_time == None
+            ).update(
+                {
+                    Quota.stop_time: stop_time,
+                    Quota.close_reason: close_reason
+                },
+                synchronize_session=False
+            )
+        if updated_count:
+            closed_count += 1
+            ledger_rows += ledger_rows_for_session(quota.username, quota.lab_short_name, quota.cpu_hour, quota.start_time, stop_time)
+            usage_rows += daily_usage_rows_for_session(quota.username, quota.lab_short_name, quota.profile_name, quota.cpu_hour, quota.start_time, stop_time)
+
+    add_to_ledger(db, ledger_rows)
+    add_to_daily_usage(db, usage_rows)
+
+    return closed_count
+
+def _open_sessions_query(db: Session):
+    return db.query(
+            Quota.id,
+            Quota.spawner_instance_id,
+            Quota.username,
+            Quota.lab_short_name,
+            Quota.profile_name,
+            Quota.cpu_hour,
+            Quota.start_time,
+            Quota.heartbeat_time
+        ).filter(
+            Quota.stop_time == None
+        )
+
+def _correct_reaped_sessions(db: Session, quotas: list, stop_time_of) -> int:
+    """
+    Replace the stop time the reaper guessed with the session's real stop time and add the difference in hours to the quota ledger and daily usage rollup.
+    The caller is responsible for committing.
+
+    quotas: reaped rows with id, username, lab_short_name, profile_name, cpu_hour, start_time, stop_time and close_reason
+    stop_time_of: callable giving the real stop time of a row
+
+    return: number of sessions corrected
+    """
+    corrected_count = 0
+    ledger_rows = []
+    usage_rows = []
+    for quota in quotas:
+        stop_time = max(stop_time_of(quota), quota.start_time)
+
+        # Only the request that actually corrects the session changes the ledger
+        updated_count = db.query(Quota).filter(
+                Quota.id == quota.id,
+                Quota.close_reason == quota.close_reason,
+                Quota.stop_time == quota.stop_time
+            ).update(
+                {
+                    Quota.stop_time: stop_time,
+                    Quota.close_reason: 'stop'
+                },
+                synchronize_session=False
+            )
+        if not updated_count:
+            continue
+        corrected_count += 1
+
+        # The hours between the reaped and the real stop time are added, or taken off if the session stopped earlier
+        if stop_time >= quota.stop_time:
+            sign, begin_time, end_time = 1.0, quota.stop_time, stop_time
+        else:
+            sign, begin_time, end_time = -1.0, stop_time, quota.stop_time
+
+        for row in ledger_rows_for_session(quota.username, quota.lab_short_name, quota.cpu_hour, begin_time, end_time):
+            ledger_rows.append({**row, 'credits_used': sign * row['credits_used'], 'hours': sign * row['hours']})
+        for row in daily_usage_rows_for_session(quota.username, quota.lab_short_name, quota.profile_name, quota.cpu_hour, begin_time, end_time):
+            usage_rows.append({**row, 'credits_used': sign * row['credits_used'], 'hours': sign * row['hours']})
+
+    add_to_ledger(db, ledger_rows)
+    add_to_daily_usage(db, usage_rows)
+
+    return corrected_count
+
+@run_in_db_executor
+def update_quota_for_stop(events: list, db: Session) -> list:
+    """
+    Set the stop time of the spawners' open sessions and add the sessions to the quota ledger and daily usage rollup.
+    Sessions already stopped are left as is, so retried stops are harmless. If a spawner is stopped more than once within `events`, the first stop wins.
+
+    A session closed by the reaper is given its real stop time instead, with the ledger and daily usage corrected by the difference.
+
+    return: (username, lab_short_name) of the sessions stopped
+    """
+    stop_times = {}
+    for data in events:
+        stop_times.setdefault(data['spawner_instance_id'], to_datetime(data['stop_time']))
+
+    quotas = db.query(
+            Quota.id,
+            Quota.spawner_instance_id,
+            Quota.username,
+            Quota.lab_short_name,
+            Quota.profile_name,
+            Quota.cpu_hour,
+            Quota.start_time,
+            Quota.heartbeat_time,
+            Quota.stop_time,
+            Quota.close_reason
+        ).filter(
+            Quota.spawner_instance_id.in_(list(stop_times.keys())),
+            or_(
+                Quota.stop_time == None,
+                Quota.close_reason.in_(REAPED_CLOSE_REASONS)
+            )
+        ).all()
+
+    def stop_time_of(quota):
+        return stop_times[quota.spawner_instance_id]
+
+    _close_sessions(db, [quota for quota in quotas if quota.stop_time is None], 'stop', stop_time_of)
+    _correct_reaped_sessions(db, [quota for quota in quotas if quota.stop_time is not None], stop_time_of)
     db.commit()
 
-async def update_quota_for_stop(data, db: Session) -> None:
+    return sorted({(quota.username, quota.lab_short_name) for quota in quotas})
+
+@run_in_db_executor
+def update_quota_for_heartbeat(events: list, db: Session) -> None:
+    """
+    Record that the spawners' open sessions are still running.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    rows = [
+        {
+            'b_spawner_instance_id': data['spawner_instance_id'],
+            'b_heartbeat_time': to_datetime(data.get('heartbeat_time', None)) or now
+        } for data in events
+    ]
+    if not rows:
+        return
 
-    db.query(Quota).filter(
-            Quota.spawner_instance_id == data['spawner_instance_id']
-        ).update(
-            {
-                Quota.stop_time: data['stop_time']
-            },
-            synchronize_session=False
+    stmt = update(Quota.__table__).where(
+            Quota.__table__.c.spawner_instance_id == bindparam('b_spawner_instance_id'),
+            Quota.__table__.c.stop_time == None
+        ).values(
+            heartbeat_time=bindparam('b_heartbeat_time')
         )
+    db.connection().execute(stmt, rows)
     db.commit()
 
-async def get_quotas_used_within_time_period(username: str, lab_short_name: str, begin_time: datetime, end_time: datetime, db: Session) -> float:
+@run_in_db_executor
+def get_quotas_used_within_time_period(username: str, lab_short_name: str, begin_time: datetime, end_time: datetime, db: Session) -> float:
+    begin_time = to_datetime(begin_time)
+    end_time = to_datetime(end_time)
+
     records = db.query(
             Quota.profile_name,
             Quota.cpu_hour,
@@ -63,3 +288,250 @@ async def get_quotas_used_within_time_period(username: str, lab_short_name: str,
     if not records:
         return []
     return [convert_to_dict(record) for record in records]
+
+def _get_credits_used_since_month_for_pairs(pairs: list, month_from: date, now: datetime, db: Session, lab_short_name: str=None) -> dict:
+    """
+    Credits used from the start of `month_from` until `now`: the ledger totals of closed sessions plus the running sessions up to `now`.
+    Only the part of a running session after the start of `month_from` is counted.
+
+    One query over the ledger and one over the running sessions, whatever the number of pairs.
+
+    pairs: list of (username, lab_short_name)
+    lab_short_name: if given, all users with usage in the lab are included as well as `pairs`
+
+    return: {(username, lab_short_name): {'total_credits_used': float, 'cpu_hour': cpu_hour of the latest running or else stopped session}}
+        Pairs with no usage are left out.
+    """
+    pairs = list(set(pairs or []))
+    if not pairs and not lab_short_name:
+        return {}
+
+    def pairs_filter(model):
+        conditions = []
+        if pairs:
+            conditions.append(tuple_(model.username, model.lab_short_name).in_(pairs))
+        if lab_short_name:
+            conditions.append(model.lab_short_name == lab_short_name)
+        return or_(*conditions)
+
+    ledger_records = db.query(
+            QuotaLedger.username,
+            QuotaLedger.lab_short_name,
+            QuotaLedger.credits_used,
+            QuotaLedger.last_cpu_hour
+        ).filter(
+            pairs_filter(QuotaLedger),
+            QuotaLedger.month >= month_from
+        ).order_by(
+            QuotaLedger.month
+        ).all()
+
+    open_records = db.query(
+            Quota.username,
+            Quota.lab_short_name,
+            Quota.cpu_hour,
+            Quota.start_time
+        ).filter(
+            pairs_filter(Quota),
+            Quota.stop_time == None
+        ).order_by(
+            Quota.start_time
+        ).all()
+
+    window_start = datetime.combine(month_from, time())
+
+    credits = {}
+    for record in ledger_records:
+        entry = credits.setdefault((record.username, record.lab_short_name), {'total_credits_used': 0.0, 'cpu_hour': None})
+        entry['total_credits_used'] += record.credits_used or 0.0
+        entry['cpu_hour'] = record.last_cpu_hour
+
+    # Running sessions come last so that the cpu_hour of the latest one wins
+    for record in open_records:
+        entry = credits.setdefault((record.username, record.lab_short_name), {'total_credits_used': 0.0, 'cpu_hour': None})
+        entry['cpu_hour'] = record.cpu_hour
+        if not record.start_time:
+            continue
+        hours = max((now - max(record.start_time, window_start)).total_seconds() / 3600.0, 0.0)
+        entry['total_credits_used'] += hours * (record.cpu_hour or 0.0)
+
+    return credits
+
+@run_in_db_executor
+def get_credits_used_since_month(username: str, lab_short_name: str, month_from: date, now: datetime, db: Session) -> dict:
+    """
+    See `_get_credits_used_since_month_for_pairs`. Returns None if there is no usage.
+    """
+    credits = _get_credits_used_since_month_for_pairs([(username, lab_short_name)], month_from, now, db)
+    return credits.get((username, lab_short_name), None)
+
+@run_in_db_executor
+def get_credits_used_since_month_for_pairs(pairs: list, month_from: date, now: datetime, db: Session, lab_short_name: str=None) -> dict:
+    return _get_credits_used_since_month_for_pairs(pairs, month_from, now, db, lab_short_name=lab_short_name)
+
+USAGE_GROUP_BY_FIELDS = ['lab_short_name', 'profile_name', 'username', 'day']
+
+@run_in_db_executor
+def get_usage_report(db: Session, day_from: date, day_to: date, group_by: list, lab_short_names: list=None, now: datetime=None) -> list:
+    """
+    Hours and credits used within [day_from, day_to], summed by the `group_by` fields (any of USAGE_GROUP_BY_FIELDS).
+
+    Closed sessions come from the daily usage rollup, grouped in SQL. Running sessions are added up to `now`.
+
+    return: [{**group_by fields, 'hours': float, 'credits_used': float}, ...] ordered by the group_by fields
+    """
+    if now is None:
+        now = datetime.now()
+
+    group_columns = [getattr(QuotaUsageDaily, field) for field in group_by]
+
+    query = db.query(
+            *group_columns,
+            func.sum(QuotaUsageDaily.hours).label('hours'),
+            func.sum(QuotaUsageDaily.credits_used).label('credits_used')
+        ).filter(
+            QuotaUsageDaily.day >= day_from,
+            QuotaUsageDaily.day <= day_to
+        )
+    if lab_short_names:
+        query = query.filter(QuotaUsageDaily.lab_short_name.in_(lab_short_names))
+    if group_columns:
+        query = query.group_by(*group_columns)
+
+    usage = {}
+    for record in query.all():
+        key = tuple(getattr(record, field) for field in group_by)
+        usage[key] = {'hours': record.hours or 0.0, 'credits_used': record.credits_used or 0.0}
+
+    window_start = datetime.combine(day_from, time())
+    window_stop = min(now, datetime.combine(day_to + timedelta(days=1), time()))
+
+    open_query = db.query(
+            Quota.username,
+            Quota.lab_short_name,
+            Quota.profile_name,
+            Quota.cpu_hour,
+            Quota.start_time
+        ).filter(
+            Quota.stop_time == None,
+            Quota.start_time < window_stop
+        )
+    if lab_short_names:
+        open_query = open_query.filter(Quota.lab_short_name.in_(lab_short_names))
+
+    for record in open_query.all():
+        start_time = max(record.start_time, window_start)
+        for row in daily_usage_rows_for_session(record.username, record.lab_short_name, record.profile_name, record.cpu_hour, start_time, window_stop):
+            key = tuple(row[field] for field in group_by)
+            entry = usage.setdefault(key, {'hours': 0.0, 'credits_used': 0.0})
+            entry['hours'] += row['hours']
+            entry['credits_used'] += row['credits_used']
+
+    return [
+        {
+            **{field: value.isoformat() if field == 'day' else value for field, value in zip(group_by, key)},
+            **entry
+        } for key, entry in sorted(usage.items(), key=lambda item: tuple(str(value) for value in item[0]))
+    ]
+
+@run_in_db_executor
+def get_pairs_with_open_sessions(db: Session) -> list:
+    """
+    (username, lab_short_name) of every running session
+    """
+    records = db.query(
+            Quota.username,
+            Quota.lab_short_name
+        ).filter(
+            Quota.stop_time == None
+        ).distinct().all()
+
+    return [(record.username, record.lab_short_name) for record in records]
+
+# Reasons the reaper closes a session with. See `reap_stale_sessions`. A later real stop replaces them with 'stop'.
+REAPED_CLOSE_REASONS = ['missing_heartbeat', 'max_age']
+
+# Max sessions closed per transaction
+REAP_BATCH_SIZE = 500
+
+last_reap = {}
+
+def _reap(db: Session, query, close_reason: str, stop_time_of) -> int:
+    reaped_count = 0
+    while True:
+        quotas = query.limit(REAP_BATCH_SIZE).all()
+        if not quotas:
+            return reaped_count
+        reaped_count += _close_sessions(db, quotas, close_reason, stop_time_of)
+        db.commit()
+
+@run_in_db_executor
+def reap_stale_sessions(now: datetime=None) -> dict:
+    """
+    Close open sessions whose stop event was probably lost. See `quota_reaper` in database/config.py.
+
+        missing_heartbeat: the session sent heartbeats but none within the timeout. It is closed at its last heartbeat.
+        max_age: the session never sent a heartbeat and is older than the max age. It is closed at the max age.
+
+    return: {close_reason: number of sessions closed}
+    """
+    config = db_config['quota_reaper']
+    if now is None:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    counts = {close_reason: 0 for close_reason in REAPED_CLOSE_REASONS}
+
+    db = SessionLocal()
+    try:
+        if config['heartbeat_timeout_minutes']:
+            heartbeat_cutoff = now - timedelta(minutes=config['heartbeat_timeout_minutes'])
+            counts['missing_heartbeat'] = _reap(
+                db,
+                _open_sessions_query(db).filter(Quota.heartbeat_time < heartbeat_cutoff),
+                'missing_heartbeat',
+                lambda quota: quota.heartbeat_time
+            )
+
+        if config['max_session_hours']:
+            max_age = timedelta(hours=config['max_session_hours'])
+            counts['max_age'] = _reap(
+                db,
+                _open_sessions_query(db).filter(Quota.heartbeat_time == None, Quota.start_time < now - max_age),
+                'max_age',
+                lambda quota: quota.start_time + max_age
+            )
+    finally:
+        db.close()
+
+    last_reap.update({'time': now.strftime("%Y-%m-%d %H:%M:%S"), 'counts': counts})
+    if any(counts.values()):
+        log.warning(f"Reaped stale quota sessions: {counts}")
+
+    return counts
+
+@run_in_db_executor
+def get_reaper_stats(db: Session) -> dict:
+    """
+    Number of sessions closed by the reaper (and not corrected by a later real stop since), in total and at its last run in this process, and the number of sessions still open.
+    """
+    records = db.query(
+            Quota.close_reason,
+            func.count(Quota.id)
+        ).filter(
+            Quota.close_reason.in_(REAPED_CLOSE_REASONS)
+        ).group_by(
+            Quota.close_reason
+        ).all()
+
+    total_counts = {close_reason: 0 for close_reason in REAPED_CLOSE_REASONS}
+    total_counts.update({close_reason: count for close_reason, count in records})
+
+    return {
+        'total': total_counts,
+        'last_run': last_reap or None,
+        'open_sessions': db.query(func.count(Quota.id)).filter(Quota.stop_time == None).scalar()
+    }
+
+@background.periodic(db_config['quota_reaper']['interval_seconds'], name='reap_stale_quota_sessions')
+async def _reap_stale_sessions_job():
+    await reap_stale_sessions()
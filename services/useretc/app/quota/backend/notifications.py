@@ -0,0 +1,104 @@
+"""
+Push notifications for quota thresholds.
+
+When a user's projected usage for the month crosses one of the configured fractions of their time_quota, an event is published to all subscribers.
+Each threshold is only sent once per user, lab and month. That state is kept in-process, so a restart may send the latest threshold again.
+
+Recent events are kept in a buffer so that a subscriber that reconnects with the id of the last event it saw does not miss any.
+"""
+
+import asyncio
+import itertools
+from collections import deque
+
+from app.utils.logging import log
+from app.database.config import db_config
+
+config = db_config['quota_notifications']
+
+class QuotaNotifier:
+    def __init__(self, thresholds: list, buffer_size: int):
+        self.thresholds = sorted(thresholds)
+        self.events = deque(maxlen=buffer_size)
+        self.subscribers = set()
+        self._ids = itertools.count(1)
+
+        # (username, lab_short_name) => highest threshold sent within `self._month`
+        self._month = None
+        self._sent = {}
+
+    def check(self, username: str, lab_short_name: str, month: str, projected_credits: float, summary: dict) -> None:
+        """
+        Publish an event if `projected_credits` crossed a threshold not yet sent this month.
+
+        summary: the user's credits summary, as returned by the credits endpoint
+        """
+        allocated_credits = summary.get('current_monthly_allocated_credits', None)
+        if not allocated_credits:
+            return
+
+        crossed = [threshold for threshold in self.thresholds if projected_credits >= threshold * allocated_credits]
+        if not crossed:
+            return
+
+        if month != self._month:
+            self._month = month
+            self._sent.clear()
+
+        key = (username, lab_short_name)
+        if self._sent.get(key, 0) >= crossed[-1]:
+            return
+        self._sent[key] = crossed[-1]
+
+        self.publish({
+            'username': username,
+            'lab_short_name': lab_short_name,
+            'month': month,
+            'threshold': crossed[-1],
+            'projected_credits': projected_credits,
+            **summary
+        })
+
+    def publish(self, event: dict) -> None:
+        event = {'id': next(self._ids), **event}
+        self.events.append(event)
+        log.info(f"Quota notification: {event}")
+        for queue in list(self.subscribers):
+            queue.put_nowait(event)
+
+    def events_after(self, last_event_id: int, lab_short_names: list=None) -> list:
+        return [
+            event for event in self.events
+            if event['id'] > last_event_id and (not lab_short_names or event['lab_short_name'] in lab_short_names)
+        ]
+
+    async def subscribe(self, lab_short_names: list=None, last_event_id: int=None, keepalive_seconds: float=15):
+        """
+        Async generator of events, or None every `keepalive_seconds` when there are none.
+        """
+        queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        try:
+            sent_id = 0
+            if last_event_id is not None:
+                for event in self.events_after(last_event_id, lab_short_names):
+                    sent_id = event['id']
+                    yield event
+
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=keepalive_seconds)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+
+                # Skip events already replayed from the buffer
+                if event['id'] <= sent_id:
+                    continue
+                if not lab_short_names or event['lab_short_name'] in lab_short_names:
+                    sent_id = event['id']
+                    yield event
+        finally:
+            self.subscribers.discard(queue)
+
+notifier = QuotaNotifier(config['thresholds'], config['buffer_size'])
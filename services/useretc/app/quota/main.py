@@ -1,41 +1,112 @@
 from datetime import datetime
 from datetime import date
+from datetime import timezone
 import pathlib
 import json
 from urllib.parse import unquote
 
 CWD = pathlib.Path(__file__).parent.absolute().resolve()
 
-import pandas as pd
-import httpx
-from fastapi import APIRouter, Request, Depends
-from fastapi.encoders import jsonable_encoder
+from fastapi import APIRouter, Request, Depends, HTTPException, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
 from .backend import crud
+from .backend.credits import calculate_credits_used
+from .backend.notifications import notifier
+from access.backend import crud as access_crud
+from app.utils import background
+from app.utils import helps
 from app.utils.logging import log
+from app.utils.decorator import user_type
+from app.utils.stream import streaming_response
 from app.database.get_db import get_db
+from app.database.config import db_config
+from app.database.schema import SessionLocal
 from opensarlab.auth import encryptedjwt
 
 router = APIRouter(
     prefix="/quota",
 )
 
+def _decrypt_clock_events(request_data: bytes) -> list:
+    """
+    The body is an encrypted event or an encrypted list of events.
+    """
+    data = encryptedjwt.decrypt(request_data)
+    if isinstance(data, list):
+        return data
+    return [data]
+
 @router.post('/clock/start')
-async def post_user_quota_data_for_start(request: Request, db_session: Session = Depends(get_db)):
+async def post_user_quota_data_for_start(request: Request, background_tasks: BackgroundTasks, db_session: Session = Depends(get_db)):
+    """
+    Each event: {'spawner_instance_id', 'username', 'lab_short_name', 'start_time', 'profile_name', 'cpu_hour'}
+    Events are deduplicated by spawner_instance_id so retries are safe.
+    """
     request_data = await request.body()
 
     # Decrypt form data
-    data = encryptedjwt.decrypt(request_data)
-    await crud.update_quota_for_start(data, db=db_session)
+    events = _decrypt_clock_events(request_data)
+    await crud.update_quota_for_start(events, db=db_session)
+
+    pairs = sorted({(data['username'], data['lab_short_name']) for data in events})
+    background_tasks.add_task(_check_quota_thresholds, pairs, running=True)
 
 @router.post('/clock/stop')
-async def post_user_quota_data_for_stop(request: Request, db_session: Session = Depends(get_db)):
+async def post_user_quota_data_for_stop(request: Request, background_tasks: BackgroundTasks, db_session: Session = Depends(get_db)):
+    """
+    Each event: {'spawner_instance_id', 'stop_time'}
+    Only open sessions are stopped so retries are safe.
+    """
     request_data = await request.body()
 
     # Decrypt form data
-    data = encryptedjwt.decrypt(request_data)
-    await crud.update_quota_for_stop(data, db=db_session)
+    events = _decrypt_clock_events(request_data)
+    pairs = await crud.update_quota_for_stop(events, db=db_session)
+
+    background_tasks.add_task(_check_quota_thresholds, pairs, running=False)
+
+@router.post('/clock/heartbeat')
+async def post_user_quota_data_for_heartbeat(request: Request, db_session: Session = Depends(get_db)):
+    """
+    Sent by the lab every so often while a server runs. Sessions whose heartbeats stop are closed by the reaper.
+
+    Each event: {'spawner_instance_id', 'heartbeat_time' (optional, defaults to now)}
+    """
+    request_data = await request.body()
+
+    # Decrypt form data
+    events = _decrypt_clock_events(request_data)
+    await crud.update_quota_for_heartbeat(events, db=db_session)
+
+@router.get('/reaper/stats')
+@user_type('admin')
+async def get_quota_reaper_stats(request: Request, db_session: Session = Depends(get_db)) -> dict:
+    return await crud.get_reaper_stats(db=db_session)
+
+def _summarize_credits(current_monthly_allocated_credits: float, credits: dict) -> dict:
+    if not credits:
+        return {
+            "current_monthly_allocated_credits": current_monthly_allocated_credits,
+            "total_credits_used": None,
+            "estimated_hours_remaining": None
+        }
+
+    total_credits_used = credits['total_credits_used']
+
+    # Use the last session's cpu_hour since either this is an active server or best guess future server
+    cpu_hour = credits['cpu_hour']
+
+    estimated_hours_remaining = None
+    if cpu_hour:
+        estimated_hours_remaining = float(current_monthly_allocated_credits - total_credits_used) / cpu_hour
+
+    return {
+        "current_monthly_allocated_credits": current_monthly_allocated_credits,
+        "total_credits_used": total_credits_used,
+        "estimated_hours_remaining": estimated_hours_remaining
+    }
 
 @router.get('/credits/username/{username}/lab/{lab_short_name}')
 async def get_user_quota_credits_allocated_credits_to_user_per_lab(
@@ -54,99 +125,261 @@ async def get_user_quota_credits_allocated_credits_to_user_per_lab(
     #####
     # Get user quota credits currently allocated_credits
     #####
-    current_monthly_allocated_credits = 0
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            url=f"http://127.0.0.1/portal/hub/auth",
-            data=json.dumps({ 'username': f"{username}" }),
-            timeout=15
-        )
-        results = json.loads(response.text)
-        if results['message'] == 'OK':
-            user_data = encryptedjwt.decrypt(results['data'])
-            if user_data:
-                for labs in user_data['access'].items():
-                    time_quota = labs.get(lab_short_name, {}).get('time_quota', None)
-                    if time_quota:
-                        current_monthly_allocated_credits = float(time_quota)
+    time_quotas = await access_crud.get_time_quotas_for_pairs([(username, lab_short_name)], db=db_session)
+    current_monthly_allocated_credits = time_quotas[(username, lab_short_name)] or 0
 
     #####
     # Get user quota credits currently used
     #####
 
+    # Session times are stored as naive UTC, so months and now are in UTC as well
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+
     # Beginning at current month if start_time argument is not given
     if not start_time:
-        today = datetime.today().date()
-        start_time = today.replace(day=1)
-
-    if not end_time:
-        end_time = datetime.now()
-
-    # Get quota DB data including where end_time is None
-    quotas = await crud.get_quotas_used_within_time_period(
-        username=username,
-        lab_short_name=lab_short_name,
-        begin_time=start_time,
-        end_time=end_time,
-        db=db_session
-    )
-
-    quotas = jsonable_encoder(quotas)
+        start_time = now.date().replace(day=1)
 
-    def _str_to_datetime(str_dt: str) -> datetime:
-        if str_dt:
-            return datetime.strptime(str_dt, "%Y-%m-%d %H:%M:%S.%f")
-        # If stop_time is not defined, then there is probably an active server. Replace None with now() to help calculate real time.
-        else:
-            return datetime.now()
-
-    # Create pandas dataframe with DB data
-    data_frame = pd.DataFrame(columns=['profile_name', 'cpu_hour', 'start_time', 'stop_time'])
-    for quota in quotas:
-        data_frame = pd.concat([
-            data_frame, 
-            pd.DataFrame({
-                'profile_name': [quota.get('profile_name')],
-                'cpu_hour': [float(quota.get('cpu_hour'))],
-                'start_time': [_str_to_datetime(quota.get('start_time'))],
-                'stop_time': [_str_to_datetime(quota.get('stop_time'))]
-            })],
-            axis=0, ignore_index=True
+    if not end_time and start_time.day == 1:
+        # Whole months up to now come from the monthly ledger plus the running sessions
+        credits = await crud.get_credits_used_since_month(
+            username=username,
+            lab_short_name=lab_short_name,
+            month_from=start_time,
+            now=now,
+            db=db_session
         )
 
-    if data_frame.empty:
-        log.warning("No quota data found within the specified time range.")
-        return {
-            "current_monthly_allocated_credits": current_monthly_allocated_credits,
-            "total_credits_used": None,
-            "estimated_hours_remaining": None
-        }
+    else:
+        if not end_time:
+            end_time = now
 
-    # Based on usage data, calculate various numbers
-    data_frame['diff_time'] = data_frame['stop_time'] - data_frame['start_time']
+        # Get quota DB data including where end_time is None
+        quotas = await crud.get_quotas_used_within_time_period(
+            username=username,
+            lab_short_name=lab_short_name,
+            begin_time=start_time,
+            end_time=end_time,
+            db=db_session
+        )
 
-    data_frame['total_hours'] = data_frame['diff_time'].apply(lambda total_hours: total_hours.total_seconds() / 3600.0)
-    data_frame['credits_used'] = data_frame['total_hours'] * data_frame['cpu_hour']
+        credits = calculate_credits_used(quotas, now=now)
 
-    total_credits_used = float(data_frame['credits_used'].sum())
+    if not credits:
+        log.warning("No quota data found within the specified time range.")
 
     #####
-    # Get estimated quota credits remaining based on current active server
+    # Get estimated quota credits remaining based on current active server and return results
     #####
 
-    # Get last row's cpu_hour since either this is an active server or best guess future server
-    last_row = data_frame.iloc[-1:]
-    cpu_hour = float(last_row['cpu_hour'])
+    summary = _summarize_credits(current_monthly_allocated_credits, credits)
+    log.warning(f">>>>> {summary}")
 
-    log.warning(f">>>>> current_monthly_allocated_credits: {current_monthly_allocated_credits}, total_credits_used: {total_credits_used}, cpu_hour: {cpu_hour}")
-    estimated_hours_remaining = float(current_monthly_allocated_credits - total_credits_used) / cpu_hour
+    return summary
 
-    #####
-    # Return results
-    #####
+async def _get_credits_batch(body: dict, db_session: Session) -> list:
+    """
+    See `post_quota_credits_batch`.
+    """
+    try:
+        pairs = [(pair['username'], pair['lab_short_name']) for pair in body.get('pairs', [])]
+        lab_short_name = body.get('lab_short_name', None)
+        if body.get('start_time', None):
+            start_time = date.fromisoformat(body['start_time'])
+        else:
+            start_time = datetime.now(timezone.utc).date().replace(day=1)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Malformed request body... {e}")
 
-    return {
-        "current_monthly_allocated_credits": current_monthly_allocated_credits,
-        "total_credits_used": total_credits_used,
-        "estimated_hours_remaining": estimated_hours_remaining
+    if start_time.day != 1:
+        raise HTTPException(status_code=400, detail="start_time must be the first day of a month")
+
+    credits = await crud.get_credits_used_since_month_for_pairs(
+        pairs=pairs,
+        month_from=start_time,
+        now=datetime.now(timezone.utc).replace(tzinfo=None),
+        db=db_session,
+        lab_short_name=lab_short_name
+    )
+
+    all_pairs = sorted(set(pairs) | set(credits.keys()))
+
+    time_quotas = await access_crud.get_time_quotas_for_pairs(all_pairs, db=db_session)
+
+    return [
+        {
+            'username': username,
+            'lab_short_name': lab,
+            **_summarize_credits(time_quotas[(username, lab)] or 0, credits.get((username, lab), None))
+        } for username, lab in all_pairs
+    ]
+
+@router.post('/credits/batch')
+async def post_quota_credits_batch(request: Request, db_session: Session = Depends(get_db)):
+    """
+    Credits of many users at once. Body:
+
+    {
+        'pairs': [{'username': str, 'lab_short_name': str}, ...],
+        'lab_short_name': str,  # Optional. Include every user with usage in the lab.
+        'start_time': 'YYYY-MM-01'  # Optional. First day of the month to count from. Defaults to the current month.
     }
+
+    Labs send the body encrypted, like the clock events, and get the result back encrypted.
+    Admin dashboards send it as JSON with their portal cookie and get plain JSON back.
+
+    Usage comes from two queries over the monthly ledger and the running sessions. Allocations come from the cached access sheets.
+
+    return: [{'username', 'lab_short_name', 'current_monthly_allocated_credits', 'total_credits_used', 'estimated_hours_remaining'}, ...]
+    """
+    if request.headers.get('content-type', '').startswith('application/json'):
+        return await _post_quota_credits_batch_for_admin(request=request, db_session=db_session)
+
+    request_data = await request.body()
+
+    # Decrypt form data
+    try:
+        body = encryptedjwt.decrypt(request_data)
+    except Exception as e:
+        log.error(f"Could not decrypt credits batch request... {e}")
+        raise HTTPException(status_code=401)
+
+    return encryptedjwt.encrypt(await _get_credits_batch(body, db_session))
+
+@user_type('admin')
+async def _post_quota_credits_batch_for_admin(request: Request, db_session: Session) -> list:
+    body = await request.json()
+    return await _get_credits_batch(body, db_session)
+
+@router.get('/usage/report')
+@user_type('admin')
+async def get_quota_usage_report(
+    request: Request,
+    day_from: date,
+    day_to: date=None,
+    group_by: str='lab_short_name',
+    format: str='text',
+    db_session: Session = Depends(get_db)):
+    """
+    Hours and credits used per lab, profile, user and/or day within [day_from, day_to], e.g.
+
+        /quota/usage/report?day_from=2024-01-01&day_to=2024-12-31&group_by=lab_short_name,profile_name&format=csv
+
+    group_by: comma separated fields of `crud.USAGE_GROUP_BY_FIELDS`
+    lab_short_name: Optional, more than once to include any of the labs
+    format: 'text' (JSON list), 'csv', 'ndjson' or 'encrypted'
+    """
+    if not day_to:
+        day_to = datetime.now(timezone.utc).date()
+
+    group_by = [field.strip() for field in group_by.split(',') if field.strip()]
+    bad_fields = [field for field in group_by if field not in crud.USAGE_GROUP_BY_FIELDS]
+    if bad_fields:
+        raise HTTPException(status_code=400, detail=f"Cannot group by {bad_fields}. Allowed: {crud.USAGE_GROUP_BY_FIELDS}")
+
+    records = await crud.get_usage_report(
+        db=db_session,
+        day_from=day_from,
+        day_to=day_to,
+        group_by=group_by,
+        lab_short_names=request.query_params.getlist('lab_short_name'),
+        now=datetime.now(timezone.utc).replace(tzinfo=None)
+    )
+
+    return streaming_response(
+        records,
+        format=format,
+        fieldnames=group_by + ['hours', 'credits_used'],
+        filename_prefix="quota_usage"
+    )
+
+async def _check_quota_thresholds(pairs: list, running: bool) -> None:
+    """
+    Check the users' usage this month against the notification thresholds.
+
+    running: if the users have running sessions, their usage is projected one check interval ahead so that they are warned before crossing a threshold
+    """
+    if not pairs:
+        return
+
+    try:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        month_from = now.date().replace(day=1)
+
+        db_session = SessionLocal()
+        try:
+            credits = await crud.get_credits_used_since_month_for_pairs(pairs=pairs, month_from=month_from, now=now, db=db_session)
+            time_quotas = await access_crud.get_time_quotas_for_pairs(pairs, db=db_session)
+        finally:
+            db_session.close()
+
+        horizon_hours = db_config['quota_notifications']['check_interval_seconds'] / 3600.0 if running else 0.0
+
+        for username, lab_short_name in pairs:
+            pair_credits = credits.get((username, lab_short_name), None)
+            if not pair_credits:
+                continue
+            projected_credits = pair_credits['total_credits_used'] + (pair_credits['cpu_hour'] or 0.0) * horizon_hours
+            notifier.check(
+                username,
+                lab_short_name,
+                month_from.isoformat(),
+                projected_credits,
+                _summarize_credits(time_quotas[(username, lab_short_name)] or 0, pair_credits)
+            )
+
+    except Exception as e:
+        log.error(f"Could not check quota thresholds for {pairs}... {e}")
+
+@background.periodic(db_config['quota_notifications']['check_interval_seconds'], name='check_quota_thresholds', initial_delay_seconds=5)
+async def _check_running_quota_thresholds_job():
+    db_session = SessionLocal()
+    try:
+        pairs = await crud.get_pairs_with_open_sessions(db=db_session)
+    finally:
+        db_session.close()
+
+    await _check_quota_thresholds(pairs, running=True)
+
+@router.get('/notifications/stream')
+async def get_quota_notifications_stream(request: Request, last_event_id: int = None):
+    """
+    Server-sent events of users crossing their quota thresholds, e.g. `/quota/notifications/stream?lab_short_name=smce-test`
+
+        id: 12
+        event: quota_threshold
+        data: {encrypted event}
+
+    The event is encrypted with encryptedjwt, like the other data useretc serves to the labs, so only holders of the shared key can read it:
+
+        {"id": 12, "username": ..., "lab_short_name": ..., "month": "2024-01-01", "threshold": 0.9, "projected_credits": ...,
+         "current_monthly_allocated_credits": ..., "total_credits_used": ..., "estimated_hours_remaining": ...}
+
+    Admin dashboards signed in to the portal get the event as plain JSON instead.
+
+    lab_short_name: Optional, more than once to get events of any of the labs
+    last_event_id: Optional. Recent events after it are sent first. The `Last-Event-ID` header sent by reconnecting EventSource clients is also used.
+    """
+    # Labs have no portal cookie. A cookie that doesn't check out is still refused.
+    user_info = await helps.get_user_info_from_username_cookie(request)
+    is_admin = 'admin' in (user_info.get('roles', None) or [])
+
+    lab_short_names = request.query_params.getlist('lab_short_name')
+
+    if last_event_id is None and request.headers.get('last-event-id', '').isdigit():
+        last_event_id = int(request.headers['last-event-id'])
+
+    async def event_stream():
+        async for event in notifier.subscribe(lab_short_names, last_event_id, db_config['quota_notifications']['keepalive_seconds']):
+            if await request.is_disconnected():
+                break
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            data = json.dumps(event) if is_admin else encryptedjwt.encrypt(event)
+            yield f"id: {event['id']}\nevent: quota_threshold\ndata: {data}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
@@ -0,0 +1,88 @@
+"""
+Benchmark `credits.calculate_credits_used` against the previous per-record `pd.concat` loop.
+
+Times both on N generated sessions (with some still open) and checks that they agree.
+The previous loop is quadratic, so it is only run up to `legacy_max_sessions`.
+
+From within the app directory:
+
+    python quota/test/bench_calculate_credits_used.py [max_sessions] [legacy_max_sessions]
+"""
+
+import sys
+import time
+import random
+import pathlib
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+sys.path.append(str(pathlib.Path(__file__).parents[3]))
+
+from app.quota.backend.credits import calculate_credits_used
+
+max_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+legacy_max_sessions = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+NOW = datetime(2024, 2, 1)
+
+def make_quotas(num_sessions: int) -> list:
+    random.seed(num_sessions)
+    quotas = []
+    for i in range(num_sessions):
+        start_time = datetime(2024, 1, 1) + timedelta(seconds=random.randint(0, 30 * 24 * 3600))
+        is_open = random.random() < 0.01
+        quotas.append({
+            'profile_name': random.choice(['m6a.large', 'm6a.xlarge', 'g4dn.xlarge']),
+            'cpu_hour': random.choice([1.0, 2.0, 4.0]),
+            'start_time': start_time,
+            'stop_time': None if is_open else start_time + timedelta(minutes=random.randint(1, 600))
+        })
+    return quotas
+
+def legacy_calculate_credits_used(quotas: list, now: datetime) -> dict:
+    data_frame = pd.DataFrame(columns=['profile_name', 'cpu_hour', 'start_time', 'stop_time'])
+    for quota in quotas:
+        data_frame = pd.concat([
+            data_frame,
+            pd.DataFrame({
+                'profile_name': [quota.get('profile_name')],
+                'cpu_hour': [quota.get('cpu_hour')],
+                'start_time': [quota.get('start_time')],
+                'stop_time': [quota.get('stop_time') or now]
+            })],
+            axis=0, ignore_index=True
+        )
+
+    data_frame['diff_time'] = data_frame['stop_time'] - data_frame['start_time']
+    data_frame['total_hours'] = data_frame['diff_time'].apply(lambda total_hours: total_hours.total_seconds() / 3600.0)
+    data_frame['credits_used'] = data_frame['total_hours'] * data_frame['cpu_hour']
+
+    return {
+        'total_credits_used': float(data_frame['credits_used'].sum()),
+        'cpu_hour': float(data_frame.iloc[-1]['cpu_hour'])
+    }
+
+def timed(func, *args) -> tuple:
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+print(f"{'sessions':>10} {'vectorized (s)':>16} {'us/session':>12} {'legacy (s)':>12}")
+
+num_sessions = 1000
+while num_sessions <= max_sessions:
+    quotas = make_quotas(num_sessions)
+
+    result, elapsed = timed(calculate_credits_used, quotas, NOW)
+    legacy_str = '-'
+
+    if num_sessions <= legacy_max_sessions:
+        legacy_result, legacy_elapsed = timed(legacy_calculate_credits_used, quotas, NOW)
+        legacy_str = f"{legacy_elapsed:.3f}"
+        if abs(result['total_credits_used'] - legacy_result['total_credits_used']) > 1e-6 * legacy_result['total_credits_used'] \
+                or result['cpu_hour'] != legacy_result['cpu_hour']:
+            raise Exception(f"Results differ for {num_sessions} sessions: {result} != {legacy_result}")
+
+    print(f"{num_sessions:>10} {elapsed:>16.4f} {elapsed / num_sessions * 1e6:>12.2f} {legacy_str:>12}")
+    num_sessions *= 10
@@ -0,0 +1,46 @@
+"""
+Periodic background jobs run within the useretc process.
+
+Register a job with the `periodic` decorator at import time. Jobs are started and stopped with the app by `lifespan` (see main.py).
+A job that raises is logged and run again at its next interval.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from app.utils.logging import log
+
+JOBS = []
+
+def periodic(interval_seconds: float, name: str=None, initial_delay_seconds: float=60):
+    def inner_decorator(func):
+        JOBS.append({
+            'name': name or func.__name__,
+            'interval_seconds': interval_seconds,
+            'initial_delay_seconds': initial_delay_seconds,
+            'func': func
+        })
+        return func
+    return inner_decorator
+
+async def _run_periodically(job: dict) -> None:
+    await asyncio.sleep(job['initial_delay_seconds'])
+    while True:
+        try:
+            await job['func']()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f"Background job {job['name']} failed: {e}")
+        await asyncio.sleep(job['interval_seconds'])
+
+@asynccontextmanager
+async def lifespan(app):
+    tasks = [asyncio.create_task(_run_periodically(job)) for job in JOBS]
+    log.info(f"Started background jobs: {[job['name'] for job in JOBS]}")
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
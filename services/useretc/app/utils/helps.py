@@ -11,6 +11,8 @@ from fastapi.responses import RedirectResponse
 
 from opensarlab.auth import encryptedjwt
 
+from app.utils.logging import log
+
 async def get_user_email_for_username(username: str) -> str:
     """ 
     From given username, get email address from Database. If no user or error, return ''. 
@@ -104,3 +106,49 @@ async def send_email_in_portal_service(email: dict) -> None:
     async with httpx.AsyncClient() as client:
         r = await client.post(url=url, data=data, timeout=5)
     r.raise_for_status
+
+async def invalidate_portal_auth_cache(usernames: list = None) -> None:
+    """
+    Drop the portal's cached auth data for `usernames`, or for everyone if None.
+    Call this after anything that feeds the auth data changes (access rows, profile, geolocation).
+
+    Failures are only logged. The portal cache entries expire on their own shortly anyway.
+    """
+
+    data = encryptedjwt.encrypt({'usernames': usernames})
+
+    try:
+        async with httpx.AsyncClient() as client:
+            r = await client.post('http://127.0.0.1/portal/hub/auth/cache', data=data, timeout=5)
+        r.raise_for_status()
+    except Exception as e:
+        log.error(f"Could not invalidate portal auth cache for {usernames if usernames is not None else 'all users'}: {e}")
+
+def get_filters_from_query_params(request: Request, allowed_fields: list, reserved_params: list) -> dict:
+    """
+    Collect field filters from the URL query, e.g. `?country_code=US&country_code=CA` => {'country_code': ['US', 'CA']}
+
+    Params in `reserved_params` (like `limit` or `cursor`) are skipped. Any other param not in `allowed_fields` raises a 400.
+    """
+
+    filters = {}
+    for key, value in request.query_params.multi_items():
+        if key in reserved_params:
+            continue
+        if key not in allowed_fields:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Cannot filter by '{key}'. Allowed: {allowed_fields}")
+        filters.setdefault(key, []).append(value)
+
+    return filters
+
+def get_sort_from_query_param(sort: str, allowed_fields: list) -> tuple:
+    """
+    `?sort=timestamp` sorts ascending and `?sort=-timestamp` descending. Returns (field, descending).
+    """
+
+    descending = sort.startswith('-')
+    field = sort.lstrip('-')
+    if field not in allowed_fields:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Cannot sort by '{field}'. Allowed: {allowed_fields}")
+
+    return field, descending
@@ -0,0 +1,80 @@
+"""
+Stream DB records to the client in chunks so that memory use stays flat regardless of table size.
+
+`records` is any iterable of flat dicts, usually a generator over a server-side cursor (see `yield_per`).
+"""
+
+import io
+import csv
+import json
+import datetime
+
+from fastapi.responses import StreamingResponse
+
+from opensarlab.auth import encryptedjwt
+
+CHUNK_SIZE = 1000
+
+def _chunked(records, chunk_size: int):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _to_json(record: dict) -> str:
+    return json.dumps(record, default=str)
+
+def csv_stream(records, fieldnames: list, chunk_size: int=CHUNK_SIZE):
+    stream = io.StringIO()
+    writer = csv.DictWriter(stream, fieldnames=fieldnames, extrasaction='ignore')
+
+    writer.writeheader()
+    yield stream.getvalue()
+
+    for chunk in _chunked(records, chunk_size):
+        stream.seek(0)
+        stream.truncate(0)
+        writer.writerows(chunk)
+        yield stream.getvalue()
+
+def ndjson_stream(records, chunk_size: int=CHUNK_SIZE):
+    for chunk in _chunked(records, chunk_size):
+        yield "".join(f"{_to_json(record)}\n" for record in chunk)
+
+def json_stream(records, chunk_size: int=CHUNK_SIZE):
+    yield "["
+    separator = ""
+    for chunk in _chunked(records, chunk_size):
+        yield separator + ",".join(_to_json(record) for record in chunk)
+        separator = ","
+    yield "]"
+
+def encrypted_stream(records, chunk_size: int=CHUNK_SIZE):
+    """
+    One encrypted JWT per line. Each decrypts to a list of up to `chunk_size` records.
+    """
+    for chunk in _chunked(records, chunk_size):
+        yield encryptedjwt.encrypt(json.loads(json.dumps(chunk, default=str))) + "\n"
+
+def streaming_response(records, format: str, fieldnames: list, filename_prefix: str) -> StreamingResponse:
+    """
+    format: one of 'csv', 'ndjson', 'encrypted' or 'text' (a JSON list)
+    """
+
+    if format == 'csv':
+        response = StreamingResponse(csv_stream(records, fieldnames), media_type="text/csv")
+        response.headers["Content-Disposition"] = f"attachment; filename={filename_prefix}_{datetime.datetime.now()}.csv"
+        return response
+
+    elif format == 'ndjson':
+        return StreamingResponse(ndjson_stream(records), media_type="application/x-ndjson")
+
+    elif format == 'encrypted':
+        return StreamingResponse(encrypted_stream(records), media_type="text/plain")
+
+    else:
+        return StreamingResponse(json_stream(records), media_type="application/json")